@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""control24 single process mode.
+Run the daemon and the OSC client sessions together in one
+process, joined by an in-memory connection rather than a socket.
+Use control24d and control24osc separately to split them across hosts.
+"""
+
+import signal
+import sys
+import time
+from optparse import OptionError
+
+import control24d
+import control24osc
+from control24common import DEFAULTS, NetworkHelper, local_pipe, opts_common
+
+'''
+    This file is part of ReaControl24. Control Surface Middleware.
+    Copyright (C) 2018  PhaseWalker
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# Timing values in seconds
+TIMING_MAIN_LOOP = 6
+
+# Globals
+SESSIONS = []
+
+
+def close_sessions():
+    """Close the client first so it stops feeding the daemon"""
+    for session in reversed(SESSIONS):
+        session.close()
+
+
+def signal_handler(sig, stackframe):
+    """Exit the process if a signal is received"""
+    close_sessions()
+    sys.exit(0)
+
+
+# START main program
+def main():
+    """Main function declares options and initialisation routine
+    for the combined daemon and OSC client."""
+
+    # Find networks on this machine, to determine good defaults
+    # and help verify options
+    networks = NetworkHelper()
+
+    # See if this system has simple defaults we can use
+    default_iface, default_ip = networks.get_default()
+
+    # program options
+    oprs = opts_common("control24 Daemon and OSC client in one process")
+    oprs.add_option(
+        "-n",
+        "--network",
+        dest="network",
+        help="Ethernet interface to the same network as the Control24. Default = %s" %
+        default_iface)
+    default_osc_client24 = networks.ipstr_from_tuple(default_ip, DEFAULTS.get('control24osc'))
+    oprs.add_option(
+        "-l",
+        "--listen",
+        dest="listen",
+        help="accept OSC client from DAW at host:port. default %s" % default_osc_client24)
+    default_daw = networks.ipstr_from_tuple(default_ip, DEFAULTS.get('oscDaw'))
+    oprs.add_option(
+        "-c",
+        "--connect",
+        dest="connect",
+        help="Connect to DAW OSC server at host:port. default %s" % default_daw)
+    oprs.add_option(
+        "--capture-process",
+        dest="capture_process",
+        action="store_true",
+        help="capture and ACK desk packets in a separate process. default = off")
+    control24d.opts_pcap(oprs)
+    control24osc.opts_clock(oprs)
+    control24osc.opts_state(oprs)
+    control24osc.opts_query(oprs)
+    control24osc.opts_controls(oprs)
+    oprs.set_defaults(network=default_iface, listen=default_osc_client24,
+                      connect=default_daw, capture_process=False)
+    # One in-process client can only drive one desk
+    oprs.set_defaults(desks=1, desk=0, transport='mp')
+
+    # Parse and verify options
+    (opts, __) = oprs.parse_args()
+    if not networks.get(opts.network):
+        print networks
+        raise OptionError(
+            'Specified network does not exist. Known networks are listed to the output.',
+            'network'
+            )
+    if not networks.verify_ip(opts.listen.split(':')[0]):
+        raise OptionError('No network has the IP address specified.', 'listen')
+    if opts.clock_rate <= 0:
+        raise OptionError('Clock rate must be more than 0.', 'clock_rate')
+    if opts.control_window < 0:
+        raise OptionError('Control window can not be negative.', 'control_window')
+
+    # Build both sessions around the two ends of one in-memory pipe
+    daemon_end, client_end = local_pipe()
+    control24d.SESSION = control24d.C24session(opts, networks, daemon_end)
+    SESSIONS.append(control24d.SESSION)
+    control24osc.SESSION = control24osc.C24oscsession(opts, networks, client_end)
+    SESSIONS.append(control24osc.SESSION)
+
+    # Set up Interrupt signal handler so process can close cleanly
+    signal.signal(signal.SIGINT, signal_handler)
+
+    # Main Loop once sessions initiated
+    while True:
+        try:
+            time.sleep(TIMING_MAIN_LOOP)
+        except KeyboardInterrupt:
+            break
+
+    close_sessions()
+
+
+if __name__ == '__main__':
+    main()
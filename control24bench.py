@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""control24 benchmarks.
+Times the value conversions, scalar against batch, and the debug
+lines of one desk packet at INFO level. Not needed to run the
+daemon or clients.
+"""
+
+import logging
+import sys
+import time
+
+from control24codec import (fader_frame, fader_frames, fader_position,
+                            fader_positions, meter_level, meter_levels,
+                            numpy, pan_ring, pan_rings)
+from control24common import LazyHex, hexl, tracing
+
+'''
+    This file is part of ReaControl24. Control Surface Middleware.
+    Copyright (C) 2018  PhaseWalker
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+TRACKS = 24
+CODEC_LOOPS = 2000
+LOG_LOOPS = 20000
+
+
+def time_per_call(func, loops):
+    """microseconds per call of func"""
+    start = time.time()
+    for __ in xrange(loops):
+        func()
+    return (time.time() - start) / loops * 1e6
+
+
+def bench_codec():
+    """Time the scalar and batch conversions, and check they agree"""
+    gains = [track / float(TRACKS) for track in range(TRACKS)]
+    positions = [fader_position(gain) for gain in gains]
+    assert list(fader_positions(gains)) == positions
+    assert fader_frames(positions) == ''.join(
+        fader_frame(track, position) for track, position in enumerate(positions))
+    assert list(pan_rings(gains)) == [pan_ring(pan) for pan in gains]
+    assert list(meter_levels(gains)) == [meter_level(val) for val in gains]
+    for name, scalar, batch in (
+            ('fader positions', lambda: [fader_position(gain) for gain in gains],
+             lambda: fader_positions(gains)),
+            ('fader frames', lambda: [fader_frame(track, position)
+                                      for track, position in enumerate(positions)],
+             lambda: fader_frames(positions)),
+            ('pan rings', lambda: [pan_ring(pan) for pan in gains],
+             lambda: pan_rings(gains)),
+            ('meter levels', lambda: [meter_level(val) for val in gains],
+             lambda: meter_levels(gains))):
+        print '{:16} {} tracks: scalar {:.1f}us batch {:.1f}us'.format(
+            name, TRACKS, time_per_call(scalar, CODEC_LOOPS), time_per_call(batch, CODEC_LOOPS))
+    print 'batch with {}'.format('numpy' if numpy else 'python')
+
+
+def bench_logging():
+    """Time the debug lines of one desk packet at INFO level,
+    formatted eagerly, lazily and skipped by a trace guard"""
+    log = logging.getLogger('control24bench')
+    log.addHandler(logging.NullHandler())
+    log.setLevel(logging.INFO)
+    trace = tracing(log)
+    packet = '\x00\xa0\x7e\x01\x02\x03' + '\x00' * 24 + '\xb0\x01\x40\x21\x20' * 6
+
+    def eager():
+        log.debug('Packet Received: %s', hexl(packet))
+        log.debug('FROMDESK %d %d', 0, 5)
+        log.debug('TODESK %d ACK: %d', 0, 5)
+        log.debug('Sending Packet of %d bytes: %s', 30, hexl(packet[:30]))
+
+    def lazy():
+        log.debug('Packet Received: %s', LazyHex(packet))
+        log.debug('FROMDESK %d %d', 0, 5)
+        log.debug('TODESK %d ACK: %d', 0, 5)
+        log.debug('Sending Packet of %d bytes: %s', 30, LazyHex(packet))
+
+    def guarded():
+        if trace:
+            log.debug('Packet Received: %s', LazyHex(packet))
+            log.debug('FROMDESK %d %d', 0, 5)
+            log.debug('TODESK %d ACK: %d', 0, 5)
+        if trace:
+            log.debug('Sending Packet of %d bytes: %s', 30, LazyHex(packet))
+
+    for name, func in (('eager', eager), ('lazy', lazy), ('guarded', guarded)):
+        print 'debug lines {:8} {:.2f}us per packet'.format(name, time_per_call(func, LOG_LOOPS))
+
+
+def main():
+    """Run every benchmark"""
+    bench_codec()
+    bench_logging()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""Value codecs. Tables to convert between the values the DAW uses
+and the bytes the desk uses, built once at import. The batch versions
+convert a value for every track in one go, with numpy if it is
+installed and plain python if not.
+"""
+
+import struct
+from array import array
+
+from control24common import FADER_RANGE, FADER_STEP
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+    This file is part of ReaControl24. Control Surface Middleware.
+    Copyright (C) 2018  PhaseWalker
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# Pot LED ring steps, left to centre to right
+RING_STEPS = 15
+RING_CENTRE = 7
+# Meter levels, and the two bytes that light each
+METER_BYTES = (
+    (0, 0), (0, 1), (0, 3), (0, 7), (0, 15), (0, 31), (0, 63), (0, 127),
+    (1, 127), (3, 127), (7, 127), (15, 127), (31, 127), (63, 127), (127, 127)
+)
+METER_LEVELS = len(METER_BYTES)
+
+
+def tenbits(num):
+    """Return 7 bits in one byte and 3 in the next for an integer provided"""
+    num = num & 0x3FF
+    return (num >> 3, (num & 7) << 4)
+
+
+# Forward and reverse tables
+# 10 bit fader position to the two desk bytes
+FADER_BYTES = tuple(tenbits(num) for num in range(FADER_RANGE))
+# the two desk bytes, as high << 7 | low, to 10 bit fader position
+FADER_POSITIONS = array('H', ((high << 3) | ((low & 0x7F) >> 4)
+                              for high in range(128) for low in range(128)))
+# 10 bit fader position to gain
+FADER_GAINS = array('d', (num * FADER_STEP for num in range(FADER_RANGE)))
+FADER_FRAME = struct.Struct('5B')
+
+
+def fader_position(gain):
+    """10 bit fader position for a DAW gain factor 0-1"""
+    if gain > 1:
+        gain = 1
+    position = int(gain * FADER_RANGE) - 1
+    if position < 0:
+        return 0
+    return position
+
+
+def fader_position_from_bytes(high, low):
+    """10 bit fader position from the two desk bytes"""
+    return FADER_POSITIONS[(high << 7) | low]
+
+
+def fader_gain(position):
+    """DAW gain factor 0-1 for a 10 bit fader position"""
+    return FADER_GAINS[position]
+
+
+def fader_frame(track_number, position):
+    """the desk command to move a fader"""
+    high, low = FADER_BYTES[position]
+    return FADER_FRAME.pack(0xB0, track_number & 0x1F, high, track_number + 0x20, low)
+
+
+def pan_ring(pan):
+    """LED ring step for a DAW pan value 0-1"""
+    if pan <= 0:
+        return 0
+    if pan >= 1:
+        return RING_STEPS - 1
+    return int((pan - 0.5) * 16) + RING_CENTRE
+
+
+def meter_level(val):
+    """meter level for a DAW meter value 0-1"""
+    if val <= 0:
+        return 0
+    return min(int(val * METER_LEVELS), METER_LEVELS - 1)
+
+
+def meter_bytes(val):
+    """the two desk bytes for a DAW meter value 0-1"""
+    return METER_BYTES[meter_level(val)]
+
+
+# Batch versions, taking and returning a value per track
+if numpy is None:
+
+    def fader_positions(gains):
+        """10 bit fader positions for DAW gains"""
+        return [fader_position(gain) for gain in gains]
+
+    def fader_frames(positions):
+        """desk commands to move each fader, track numbers
+        counting from 0, as one string"""
+        return ''.join(fader_frame(track_number, position)
+                       for track_number, position in enumerate(positions))
+
+    def pan_rings(pans):
+        """LED ring steps for DAW pan values"""
+        return [pan_ring(pan) for pan in pans]
+
+    def meter_levels(vals):
+        """meter levels for DAW meter values"""
+        return [meter_level(val) for val in vals]
+
+else:
+    FADER_BYTES_NP = numpy.array(FADER_BYTES, dtype=numpy.uint8)
+
+    def fader_positions(gains):
+        """10 bit fader positions for DAW gains"""
+        gains = numpy.minimum(numpy.asarray(gains, dtype=numpy.float64), 1)
+        positions = (gains * FADER_RANGE).astype(numpy.int32) - 1
+        return numpy.clip(positions, 0, FADER_RANGE - 1)
+
+    def fader_frames(positions):
+        """desk commands to move each fader, track numbers
+        counting from 0, as one string"""
+        positions = numpy.asarray(positions, dtype=numpy.int32) & 0x3FF
+        tracks = numpy.arange(len(positions))
+        frames = numpy.empty((len(positions), 5), dtype=numpy.uint8)
+        frames[:, 0] = 0xB0
+        frames[:, 1] = tracks & 0x1F
+        frames[:, 2:5:2] = FADER_BYTES_NP[positions]
+        frames[:, 3] = tracks + 0x20
+        return frames.tostring()
+
+    def pan_rings(pans):
+        """LED ring steps for DAW pan values"""
+        pans = numpy.asarray(pans, dtype=numpy.float64)
+        rings = numpy.trunc((pans - 0.5) * 16).astype(numpy.int32) + RING_CENTRE
+        rings[pans <= 0] = 0
+        rings[pans >= 1] = RING_STEPS - 1
+        return rings
+
+    def meter_levels(vals):
+        """meter levels for DAW meter values"""
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+        levels = (numpy.maximum(vals, 0) * METER_LEVELS).astype(numpy.int32)
+        return numpy.minimum(levels, METER_LEVELS - 1)
+
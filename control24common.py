@@ -1,12 +1,20 @@
 """Control24 common functions and default settings"""
 
 import binascii
+import collections
 import datetime
+import heapq
+import itertools
 import logging
 import optparse
 import os
+import Queue
+import socket
+import struct
+import threading
 import time
 import sys
+from multiprocessing.connection import answer_challenge, deliver_challenge
 
 import netifaces
 
@@ -36,6 +44,7 @@ DEFAULTS = {
     'daemon':9123,
     'control24osc':9124,
     'oscDaw':9125,
+    'query':9126,
     'auth':'be_in-control',
     'loglevel':logging.INFO,
     'interface':'en0',
@@ -50,6 +59,57 @@ COMMANDS = {
     'online': 0xE2
 }
 
+# Messages between daemon and clients starting with this byte are
+# for the daemon or client itself rather than the desk
+MP_CONTROL = '\xfe'
+MP_SUBSCRIBE = MP_CONTROL + 'S'
+MP_DESK = MP_CONTROL + 'D'
+MP_BATCH = MP_CONTROL + 'B'
+# From the daemon: the client's desk is (back) online and needs its state
+MP_ONLINE = MP_CONTROL + 'O'
+# A batch must fit the daemon's room for commands in one desk packet
+MP_BATCH_BYTES = 314 - 30
+MP_BATCH_CMDS = 48
+
+# Priority classes of commands going to the desk, highest first.
+# Each class is sent this many commands per round while busy,
+# so the lower ones always get some share of the desk
+CLASS_INTERACTIVE = 0   # button LEDs, pot rings, automation LEDs
+CLASS_MOTOR = 1         # fader positions
+CLASS_DISPLAY = 2       # scribble strips
+CLASS_METER = 3         # meters and clock
+CLASS_NAMES = ('interactive', 'motor', 'display', 'meter')
+CLASS_SHARES = (8, 4, 2, 1)
+# By first byte, and by the fourth for the 0xF0 0x13 0x01 display commands
+COMMAND_CLASSES = {0x90: CLASS_INTERACTIVE, 0xB0: CLASS_MOTOR}
+DISPLAY_CLASSES = {0x00: CLASS_INTERACTIVE, 0x10: CLASS_METER,
+                   0x20: CLASS_INTERACTIVE, 0x30: CLASS_METER,
+                   0x40: CLASS_DISPLAY}
+# What a full class queue does with one more. Buttons are never dropped,
+# and faders, pots and strips are bounded by replacing any queued
+# command for the same control. Meters and clock just drop the oldest
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop-oldest'
+CLASS_POLICIES = (POLICY_BLOCK, POLICY_BLOCK, POLICY_BLOCK, POLICY_DROP_OLDEST)
+# Display commands that set one control, so a newer one replaces it
+KEYED_DISPLAYS = frozenset([0x00, 0x20, 0x40])
+
+# Remote link framing. Each write is one frame of a kind byte and
+# 2 byte length, a data frame carries many length prefixed messages
+LINK_FRAME = struct.Struct('>BH')
+LINK_RECORD = struct.Struct('>H')
+LINK_STAMP = struct.Struct('>d')
+LINK_DATA = 1
+LINK_PING = 2
+LINK_PONG = 3
+LINK_AUTH = 4
+LINK_BATCH_BYTES = 8192
+
+# Remote link timing values in seconds
+TIMING_LINK_HEARTBEAT = 0.05    # Ping this often, busy or not
+TIMING_LINK_TIMEOUT = 0.2       # Link is dead if nothing is heard for this long
+TIMING_LINK_CONNECT = 2         # Allowance for the connection and challenge
+
 CHANNELS = 24
 FADER_RANGE = 2**10
 FADER_STEP = 1 / float(FADER_RANGE)
@@ -103,6 +163,19 @@ def start_logging(name, logdir, debug=False):
     return root_logger
 
 
+def opts_transport(oprs):
+    """Add the option to choose how daemon and clients connect"""
+    oprs.add_option(
+        "-t",
+        "--transport",
+        dest="transport",
+        type="choice",
+        choices=['mp', 'link'],
+        help="connection between daemon and clients: mp (multiprocessing) or" +
+        " link (low latency, for separate hosts). Both ends must match. default = mp")
+    oprs.set_defaults(transport='mp')
+
+
 def opts_common(desc):
     """Set up an opts object with options we use everywhere"""
     fulldesc = desc + """
@@ -128,6 +201,169 @@ def opts_common(desc):
 
 
 
+def mp_subscribe(conn, cmdbytes):
+    """Ask the daemon to forward only those desk commands that
+    start with a byte in cmdbytes. An empty list asks for all"""
+    conn.send_bytes(MP_SUBSCRIBE + ''.join(chr(byt) for byt in cmdbytes))
+
+
+def mp_select_desk(conn, index):
+    """Ask the daemon to connect this client to the desk with the
+    index given, in the order desks were detected. Default is 0"""
+    conn.send_bytes(MP_DESK + chr(index))
+
+
+def mp_batches(cmds):
+    """Yield batch messages for a list of desk commands to go out
+    together, packed into as few desk packets as they will fit"""
+    batch = []
+    size = 0
+    for cmd in cmds:
+        if batch and (size + len(cmd) > MP_BATCH_BYTES or
+                      len(batch) == MP_BATCH_CMDS):
+            yield MP_BATCH + chr(len(batch)) + ''.join(batch)
+            batch = []
+            size = 0
+        batch.append(cmd)
+        size += len(cmd)
+    if batch:
+        yield MP_BATCH + chr(len(batch)) + ''.join(batch)
+
+
+def mp_send_batch(conn, cmds):
+    """Send a list of desk commands to go out together"""
+    for msg in mp_batches(cmds):
+        conn.send_bytes(msg)
+
+
+def command_key(cmd):
+    """return a key for the control a desk command sets, if a newer
+    command for it can replace this one, otherwise None"""
+    first = ord(cmd[0])
+    if first == 0xB0:
+        return cmd[:2]
+    if first == 0xF0 and len(cmd) > 4 and ord(cmd[3]) & 0xF0 in KEYED_DISPLAYS:
+        # the top bits of the track byte are data, a pot ring sets 0x40
+        # on some steps, so mask them off to keep one key per control
+        return cmd[:4] + chr(ord(cmd[4]) & 0x3F)
+    return None
+
+
+def classify(cmd):
+    """return the priority class of a desk command, or of the
+    first command in a batch"""
+    if cmd[:2] == MP_BATCH:
+        cmd = cmd[3:]
+    first = ord(cmd[0])
+    if first == 0xF0 and len(cmd) > 3:
+        return DISPLAY_CLASSES.get(ord(cmd[3]) & 0xF0, CLASS_DISPLAY)
+    return COMMAND_CLASSES.get(first, CLASS_DISPLAY)
+
+
+class ClassQueue(object):
+    """A bounded queue for each priority class. The highest class
+    with anything queued goes first, until it has had its share for
+    the round, so the lower classes are never starved. An item with
+    a key replaces the one queued with the same key, and a full class
+    blocks or drops its oldest by its policy. The time each item
+    waited is kept per class, as are the drops and replacements"""
+
+    def __init__(self, maxsize, shares=CLASS_SHARES, policies=CLASS_POLICIES):
+        self.queues = [collections.deque() for __ in shares]
+        self.keyed = [{} for __ in shares]
+        self.shares = shares
+        self.policies = policies
+        self.credit = list(shares)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        # count, total and worst wait for each class
+        self.waits = [[0, 0.0, 0.0] for __ in shares]
+        self.dropped = [0] * len(shares)
+        self.replaced = [0] * len(shares)
+
+    def __str__(self):
+        return ' '.join(
+            '{}:{}/{:.1f}/{:.1f}ms drop:{} repl:{}'.format(
+                CLASS_NAMES[cls], count, total / count * 1000 if count else 0.0,
+                worst * 1000, self.dropped[cls], self.replaced[cls])
+            for cls, (count, total, worst) in enumerate(self.waits))
+
+    def qsize(self):
+        """number of items queued in all classes"""
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, cls, item, key=None, block=True):
+        """queue an item in its class, or in place of the one queued
+        with the same key. If the class is full, drop its oldest or
+        wait for room by its policy. Raises Queue.Full if it would
+        wait and block is False"""
+        with self.not_full:
+            queue = self.queues[cls]
+            if not key is None:
+                entry = self.keyed[cls].get(key)
+                if not entry is None:
+                    entry[1] = item
+                    self.replaced[cls] += 1
+                    return
+            while len(queue) >= self.maxsize:
+                if self.policies[cls] == POLICY_DROP_OLDEST:
+                    self._forget(cls, queue.popleft())
+                    self.dropped[cls] += 1
+                elif not block:
+                    raise Queue.Full
+                else:
+                    self.not_full.wait()
+            entry = [tick(), item, key]
+            queue.append(entry)
+            if not key is None:
+                self.keyed[cls][key] = entry
+
+    def _forget(self, cls, entry):
+        if not entry[2] is None and self.keyed[cls].get(entry[2]) is entry:
+            del self.keyed[cls][entry[2]]
+
+    def get_nowait(self):
+        """return (class, item) for the next item due,
+        raise Queue.Empty if there are none"""
+        with self.lock:
+            cls = self._pick()
+            if cls is None:
+                raise Queue.Empty
+            self.credit[cls] -= 1
+            entry = self.queues[cls].popleft()
+            self._forget(cls, entry)
+            queued, item = entry[0], entry[1]
+            self.not_full.notify_all()
+            wait = tick() - queued
+            waits = self.waits[cls]
+            waits[0] += 1
+            waits[1] += wait
+            if wait > waits[2]:
+                waits[2] = wait
+            return cls, item
+
+    def _pick(self):
+        for cls, queue in enumerate(self.queues):
+            if queue and self.credit[cls] > 0:
+                return cls
+        # every class with anything queued has had its share
+        self.credit = list(self.shares)
+        for cls, queue in enumerate(self.queues):
+            if queue:
+                return cls
+        return None
+
+    def dropped_total(self):
+        """number of items dropped from all classes"""
+        return sum(self.dropped)
+
+    def reset_waits(self):
+        """start the wait times afresh, the drop counts carry on"""
+        with self.lock:
+            self.waits = [[0, 0.0, 0.0] for __ in self.shares]
+
+
 def hexl(inp):
     """Convert to hex string using binascii but
     then pretty it up by spacing the groups"""
@@ -135,6 +371,451 @@ def hexl(inp):
     return ' '.join([shex[i:i+2] for i in range(0, len(shex), 2)])
 
 
+class LazyHex(object):
+    """Log argument that is only turned into hex if the line is
+    written, for example LOG.debug('data %s', LazyHex(data))"""
+    __slots__ = ('data', )
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return hexl(self.data)
+
+
+class LazyFormat(object):
+    """Log argument that calls func(*args) for its text,
+    only if the line is written"""
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def tracing(log):
+    """True if the log writes debug lines. The level is set once
+    when logging starts, so hot paths keep this in a TRACE global
+    and test that before any debug line"""
+    return log.isEnabledFor(logging.DEBUG)
+
+
+
+class LocalConnection(object):
+    """In-process stand in for a multiprocessing Connection, used when
+    the daemon and a client share one process. Buffers are handed over
+    through queues as plain strings, so nothing is pickled, framed or
+    pushed through a socket. Only the methods used by the daemon and
+    client loops are provided"""
+    def __init__(self, inbound, outbound):
+        self.inbound = inbound
+        self.outbound = outbound
+        self.pending = None
+        self.closed = False
+        self.peer = None
+        self.receiver = None
+
+    def deliver(self, receiver):
+        """hand what the other end sends straight to receiver, in
+        the sender's thread, rather than queueing it for recv_bytes.
+        receiver is given None when the other end closes"""
+        self.receiver = receiver
+
+    def send_bytes(self, buf):
+        """pass a copy of the buffer to the other end"""
+        if self.closed:
+            raise IOError('LocalConnection is closed')
+        if not isinstance(buf, str):
+            buf = str(bytearray(buf))
+        receiver = self.peer.receiver
+        if receiver is None:
+            self.outbound.put(buf)
+        else:
+            receiver(buf)
+
+    def poll(self, timeout=0.0):
+        """True if a buffer is waiting, blocking up to timeout seconds"""
+        if self.pending is None:
+            try:
+                if timeout:
+                    self.pending = self.inbound.get(True, timeout)
+                else:
+                    self.pending = self.inbound.get_nowait()
+            except Queue.Empty:
+                return False
+        return True
+
+    def recv_bytes(self):
+        """block until the next buffer arrives and return it"""
+        if self.pending is None:
+            buf = self.inbound.get()
+        else:
+            buf, self.pending = self.pending, None
+        if buf is None:
+            # the other end closed
+            self.closed = True
+            raise EOFError
+        return buf
+
+    def recv_bytes_into(self, buf, offset=0):
+        """receive into a ctypes string buffer, return the size"""
+        data = self.recv_bytes()
+        buf[offset:offset + len(data)] = data
+        return len(data)
+
+    def close(self):
+        """signal the other end that we are gone"""
+        if not self.closed:
+            self.closed = True
+            receiver = self.peer.receiver
+            if receiver is None:
+                self.outbound.put(None)
+            else:
+                receiver(None)
+
+    def fileno(self):
+        """there is no descriptor, but loggers like to show one"""
+        return -1
+
+
+def local_pipe():
+    """Return a connected pair of LocalConnection objects
+    in the manner of multiprocessing.Pipe"""
+    one_way = Queue.Queue()
+    other_way = Queue.Queue()
+    one_end = LocalConnection(one_way, other_way)
+    other_end = LocalConnection(other_way, one_way)
+    one_end.peer = other_end
+    other_end.peer = one_end
+    return one_end, other_end
+
+
+class LinkConnection(object):
+    """Connection for the daemon and a client on separate hosts.
+    Quacks like a multiprocessing Connection but the socket has
+    TCP_NODELAY, everything queued is batched into one write, and
+    heartbeats both prove the link is alive and measure round trip.
+    Heartbeats are answered by a reader thread, so they don't wait
+    on whoever consumes the messages"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(TIMING_LINK_CONNECT)
+        self.raw = _LinkAuth(self)
+        self.recvq = Queue.Queue()
+        self.sendq = Queue.Queue()
+        # a message taken off the receive queue by poll, if any
+        self.pending = []
+        self.closed = False
+        self.rtt = None
+        self.rtt_last = None
+        self.thread_writer = threading.Thread(
+            target=self._writer, name='thread_link_writer')
+        self.thread_writer.daemon = True
+        self.thread_reader = threading.Thread(
+            target=self._reader, name='thread_link_reader')
+        self.thread_reader.daemon = True
+
+    def start(self):
+        """once authenticated, tighten the timeout and start
+        reading and writing"""
+        self.sock.settimeout(TIMING_LINK_TIMEOUT)
+        self.thread_reader.start()
+        self.thread_writer.start()
+
+    def send_bytes(self, buf):
+        """queue a copy of the buffer for the next batch"""
+        if self.closed:
+            raise IOError('LinkConnection is closed')
+        if not isinstance(buf, str):
+            buf = str(bytearray(buf))
+        self.sendq.put(buf)
+
+    def poll(self, timeout=0.0):
+        """True if a message is waiting, or the link has closed,
+        blocking up to timeout seconds"""
+        if not self.pending:
+            try:
+                if timeout:
+                    self.pending.append(self.recvq.get(True, timeout))
+                else:
+                    self.pending.append(self.recvq.get_nowait())
+            except Queue.Empty:
+                return False
+        return True
+
+    def recv_bytes(self):
+        """block until the next message arrives and return it"""
+        if self.pending:
+            buf = self.pending.pop()
+        else:
+            buf = self.recvq.get()
+        if buf is None:
+            # put it back for any further callers
+            self.recvq.put(None)
+            raise EOFError('Link closed')
+        return buf
+
+    def close(self):
+        """stop the writer and shut the socket"""
+        if not self.closed:
+            self.closed = True
+            self.sendq.put(None)
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+    def fileno(self):
+        """socket descriptor, mostly for logging"""
+        return self.sock.fileno()
+
+    def send_frame(self, kind, body):
+        """write one whole frame to the socket"""
+        self.sock.sendall(LINK_FRAME.pack(kind, len(body)) + body)
+
+    def recv_frame(self):
+        """read one whole frame from the socket"""
+        kind, size = LINK_FRAME.unpack(self._recv_exact(LINK_FRAME.size))
+        return kind, self._recv_exact(size)
+
+    def _recv_exact(self, size):
+        pieces = []
+        while size:
+            try:
+                piece = self.sock.recv(size)
+            except socket.timeout:
+                raise EOFError('Link timed out')
+            except socket.error:
+                raise EOFError('Link reset')
+            if not piece:
+                raise EOFError('Link closed')
+            pieces.append(piece)
+            size -= len(piece)
+        return ''.join(pieces)
+
+    def _reader(self):
+        """unpack data frames onto the receive queue and answer
+        heartbeats, until the link times out or is closed"""
+        try:
+            while True:
+                kind, body = self.recv_frame()
+                if kind == LINK_DATA:
+                    psn = 0
+                    while psn < len(body):
+                        size = LINK_RECORD.unpack_from(body, psn)[0]
+                        psn += LINK_RECORD.size
+                        self.recvq.put(body[psn:psn + size])
+                        psn += size
+                elif kind == LINK_PING:
+                    self.sendq.put((LINK_PONG, body))
+                elif kind == LINK_PONG:
+                    self.rtt_last = tick() - LINK_STAMP.unpack(body)[0]
+                    if self.rtt is None:
+                        self.rtt = self.rtt_last
+                    else:
+                        self.rtt += (self.rtt_last - self.rtt) / 8
+        except EOFError:
+            self.recvq.put(None)
+            self.close()
+
+    def _writer(self):
+        """batch whatever is queued into one frame per write,
+        pinging on schedule whether busy or idle"""
+        next_ping = tick()
+        try:
+            while not self.closed:
+                wait = next_ping - tick()
+                if wait <= 0:
+                    self.send_frame(LINK_PING, LINK_STAMP.pack(tick()))
+                    next_ping = tick() + TIMING_LINK_HEARTBEAT
+                    continue
+                try:
+                    item = self.sendq.get(True, wait)
+                except Queue.Empty:
+                    continue
+                batch = []
+                size = 0
+                while True:
+                    if item is None:
+                        return
+                    if isinstance(item, tuple):
+                        self.send_frame(*item)
+                    else:
+                        batch.append(LINK_RECORD.pack(len(item)))
+                        batch.append(item)
+                        size += LINK_RECORD.size + len(item)
+                    if size >= LINK_BATCH_BYTES:
+                        break
+                    try:
+                        item = self.sendq.get_nowait()
+                    except Queue.Empty:
+                        break
+                if batch:
+                    self.send_frame(LINK_DATA, ''.join(batch))
+        except socket.error:
+            # wake the reader, which will see the link has gone
+            self.close()
+
+
+class _LinkAuth(object):
+    """Just enough of a Connection for the multiprocessing
+    challenge functions to authenticate a LinkConnection"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send_bytes(self, buf):
+        self.conn.send_frame(LINK_AUTH, buf)
+
+    def recv_bytes(self, maxlength=None):
+        __, body = self.conn.recv_frame()
+        return body
+
+
+class LinkListener(object):
+    """Listener for LinkConnections, in the manner of
+    multiprocessing.connection.Listener"""
+    def __init__(self, address, authkey):
+        self.authkey = authkey
+        self.last_accepted = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(5)
+
+    def accept(self):
+        """wait for, authenticate and return a connection"""
+        sock, self.last_accepted = self.sock.accept()
+        conn = LinkConnection(sock)
+        try:
+            deliver_challenge(conn.raw, self.authkey)
+            answer_challenge(conn.raw, self.authkey)
+        except:
+            conn.close()
+            raise
+        conn.start()
+        return conn
+
+    def close(self):
+        """stop listening, waking any thread waiting in accept"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def link_client(address, authkey):
+    """Connect to a LinkListener, in the manner of
+    multiprocessing.connection.Client"""
+    conn = LinkConnection(socket.create_connection(address, TIMING_LINK_CONNECT))
+    try:
+        answer_challenge(conn.raw, authkey)
+        deliver_challenge(conn.raw, authkey)
+    except:
+        conn.close()
+        raise
+    conn.start()
+    return conn
+
+
+class ScheduledCall(object):
+    """Handle to a call waiting in the Scheduler, which
+    can be cancelled or moved to a new time"""
+    def __init__(self, scheduler, delay, func, args):
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.when = None
+        self.pending = False
+        self.reschedule(delay)
+
+    def cancel(self):
+        """stop the call happening, if it has not already"""
+        with self.scheduler.wakeup:
+            self.pending = False
+
+    def reschedule(self, delay):
+        """make the call delay seconds from now, whether or not
+        it is still pending or was cancelled"""
+        self.scheduler.push(self, delay)
+
+    def active(self):
+        """True until the call has been made or cancelled"""
+        return self.pending
+
+
+class Scheduler(threading.Thread):
+    """One thread to make all delayed calls from a heap, rather
+    than a threading.Timer and its thread for each one.
+    Calls should be quick, they hold up the ones behind them"""
+    def __init__(self, log):
+        super(Scheduler, self).__init__()
+        self.daemon = True
+        self.name = 'thread_scheduler'
+        self.log = log
+        self.pid = os.getpid()
+        self.heap = []
+        self.order = itertools.count()
+        self.wakeup = threading.Condition(threading.Lock())
+
+    def call_later(self, delay, func, *args):
+        """call func(*args) in delay seconds, return the handle"""
+        return ScheduledCall(self, delay, func, args)
+
+    def push(self, call, delay):
+        """(re)enter a call on the heap for delay seconds from now.
+        Any entry already there for it goes stale, as its time no
+        longer matches"""
+        with self.wakeup:
+            call.when = tick() + delay
+            call.pending = True
+            heapq.heappush(self.heap, (call.when, next(self.order), call))
+            if self.heap[0][2] is call:
+                self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while True:
+                    if self.heap:
+                        when, __, call = self.heap[0]
+                        if not call.pending or call.when != when:
+                            heapq.heappop(self.heap)
+                            continue
+                        wait = when - tick()
+                        if wait <= 0:
+                            heapq.heappop(self.heap)
+                            call.pending = False
+                            break
+                        self.wakeup.wait(wait)
+                    else:
+                        self.wakeup.wait()
+            try:
+                call.func(*call.args)
+            except Exception:
+                self.log.error('Scheduled call %s failed', call.func,
+                               exc_info=True)
+
+
+SCHEDULER = None
+SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler(log):
+    """Return the scheduler for this process, starting it if needed.
+    A forked process gets its own, as threads don't survive the fork"""
+    global SCHEDULER
+    with SCHEDULER_LOCK:
+        if SCHEDULER is None or SCHEDULER.pid != os.getpid():
+            SCHEDULER = Scheduler(log)
+            SCHEDULER.start()
+        return SCHEDULER
+
 
 class NetworkHelper(object):
     """class to contain network related helpful methods
@@ -254,3 +935,4 @@ class NetworkHelper(object):
     def ipstr_from_tuple(ipaddr, ipport):
         """from ip and port provide a string with ip:port"""
         return '{}:{}'.format(ipaddr, ipport)
+
@@ -4,20 +4,29 @@ Daemon process to serve further client processes
 that can choose to implement a protocol with DAWs etc.
 """
 
+import multiprocessing
+import os
+import Queue
 import signal
+import struct
 import sys
 import threading
 import time
-from ctypes import (POINTER, BigEndianStructure, Structure, Union,
-                    addressof, c_char, c_ubyte, c_uint16,
-                    c_uint32, cast, create_string_buffer, string_at)
+from ctypes import (BigEndianStructure, Structure, Union, addressof, c_char,
+                    c_double, c_ubyte, c_uint16, c_uint32, create_string_buffer,
+                    memmove, sizeof, string_at)
 from multiprocessing.connection import AuthenticationError, Listener
 from optparse import OptionError
 
 import pcap
 
-from control24common import (DEFAULTS, COMMANDS, NetworkHelper, hexl,
-                             opts_common, start_logging, tick)
+from control24common import (DEFAULTS, COMMANDS, MP_BATCH, MP_CONTROL,
+                             MP_DESK, MP_ONLINE, MP_SUBSCRIBE, ClassQueue,
+                             LazyHex, LinkListener, LocalConnection,
+                             NetworkHelper, classify,
+                             command_key, get_scheduler, hexl, opts_common,
+                             opts_transport, start_logging, tick, tracing)
+from control24map import MAPPING_TREE
 
 '''
     This file is part of ReaControl24. Control Surface Middleware.
@@ -51,6 +60,14 @@ TIMING_LISTENER_POLL = 2        # Poll time for MP Listener to wait for data
 TIMING_LISTENER_RECONNECT = 1   # Pause before a reconnect attempt is made
 TIMING_WAIT_DESC_ACK = 0.1      # Wait period for desk to ACK after send, before warning is logged
 TIMING_BACKOFF = 0.3            # Time to pause sending data to desk after a retry packet is recvd
+TIMING_ACK_DEADLINE = 0.005     # Delta between packet arriving and ACK sent, before warning is logged.
+                                # Only watched, the desk resends if it misses an ACK
+TIMING_RING_POLL = 1            # Poll time for the capture ring reader to wait for data
+TIMING_STATS = 60               # How often session statistics are logged
+TIMING_DESK_SILENT = 2 * TIMING_KEEP_ALIVE  # A known desk broadcasting after this long unheard
+                                # has restarted. Online, it ACKs every keep alive
+TIMING_PCAP_STATS = 5           # How often the capture drop counts are read
+TIMING_DESK_LOST = 30           # A known desk unheard for this long may have been swapped
 
 # Control Constants
 
@@ -58,6 +75,7 @@ TIMING_BACKOFF = 0.3            # Time to pause sending data to desk after a ret
 
 # START Globals
 LOG = None
+TRACE = False       # debug lines on the packet paths, set with LOG
 SESSION = None
 
 # PCAP settings
@@ -67,6 +85,32 @@ PCAP_PROMISC = 1
 PCAP_PACKET_LIMIT = -1  # infinite
 PCAP_POLL_DELAY = 5
 PCAP_FILTER = '(ether dst %s or broadcast) and ether[12:2]=0x885f'
+PCAP_FILTER_DESKS = PCAP_FILTER + ' and (%s)'   # only the known desks
+
+# Packet header fields at their fixed offsets, so a packet can be
+# sorted without building the ctypes structures:
+# mac dest, mac src, sendcounter, cmdcounter, retry, c24cmd, numcommands
+PKT_HEADER = struct.Struct('>6s6s6xIIHBB')
+PKT_HEADER_LEN = PKT_HEADER.size
+# and the fields after the ethernet header, to fill in packets to send:
+# numbytes, parity, sendcounter, cmdcounter, retry, c24cmd, numcommands
+PKT_FIELDS = struct.Struct('>H2sIIHBB')
+ETH_HEADER_LEN = PKT_HEADER_LEN - PKT_FIELDS.size
+PARITY_NONE = '\x00\x00'
+MAC_BROADCAST = '\xff' * 6
+MAC_VENDOR = '\x00\xa0\x7e'
+PCAP_FILTER_NONE = 'less 1'     # for a handle that only sends
+PCAP_TIMEOUT_MS = 50            # Read timeout, when not in immediate mode
+PCAP_BUFFER = 0                 # Capture buffer bytes, 0 for the libpcap default
+
+# Multiprocessing settings
+MP_QUEUE_SIZE = 256             # Commands held for or from each client
+SPLIT_BYTES = frozenset(key for key in MAPPING_TREE if key != 0x00)
+
+# Capture process ring settings
+RING_SLOTS = 256                # must be a power of 2
+RING_DESKDATA = 1               # slot holds packet data from the desk
+RING_DISCOVERY = 2              # slot holds mac, version and device of a new desk
 
 # END Globals
 
@@ -83,6 +127,56 @@ def signal_handler(sig, stackframe):
     sys.exit(0)
 
 
+def opts_pcap(oprs):
+    """Add the packet capture tuning options, shared with control24"""
+    oprs.add_option(
+        "--pcap-buffer",
+        dest="pcap_buffer",
+        type="int",
+        help="capture buffer size in bytes. default = libpcap default")
+    oprs.add_option(
+        "--pcap-timeout",
+        dest="pcap_timeout",
+        type="int",
+        help="capture read timeout in ms, when not immediate. default = %d" % PCAP_TIMEOUT_MS)
+    oprs.add_option(
+        "--pcap-no-immediate",
+        dest="pcap_immediate",
+        action="store_false",
+        help="let the capture buffer packets until the read timeout. default = immediate")
+    oprs.set_defaults(pcap_buffer=PCAP_BUFFER, pcap_timeout=PCAP_TIMEOUT_MS,
+                      pcap_immediate=True)
+
+
+def pcap_settings(opts):
+    """the capture tuning options as a dict, for
+    sessions built from options without them"""
+    return {
+        'buffer': getattr(opts, 'pcap_buffer', PCAP_BUFFER),
+        'timeout_ms': getattr(opts, 'pcap_timeout', PCAP_TIMEOUT_MS),
+        'immediate': getattr(opts, 'pcap_immediate', True)
+    }
+
+
+def split_commands(pkt_data):
+    """Split desk packet data into commands, on the next command byte
+    or after an F7 terminator, the same way the clients do"""
+    if pkt_data[:1] == '\x00':
+        return [pkt_data]
+    cmds = []
+    start = 0
+    for psn, byt in enumerate(pkt_data):
+        if byt == '\xf7':
+            cmds.append(pkt_data[start:psn + 1])
+            start = psn + 1
+        elif ord(byt) in SPLIT_BYTES and psn > start:
+            cmds.append(pkt_data[start:psn])
+            start = psn
+    if start < len(pkt_data):
+        cmds.append(pkt_data[start:])
+    return cmds
+
+
 def compare_ctype_array(arr1, arr2):
     """Iterate and compare byte by byte all bytes in 2 ctype arrays"""
     return all(ai1 == ai2 for ai1, ai2 in zip(arr1, arr2))
@@ -251,15 +345,27 @@ class Sniffer(threading.Thread):
         super(Sniffer, self).__init__()
         self.daemon = True
         self.name = 'thread_sniffer'
-        network = c24session.network.get('pcapname')
-        c24session.pcap_sess = c24session.fpcapt.pcap(
-            name=network,
+        settings = c24session.pcap_settings
+        kwargs = dict(
+            name=c24session.network.get('pcapname'),
             promisc=True,
-            immediate=True,
-            timeout_ms=50
+            immediate=settings['immediate'],
+            timeout_ms=settings['timeout_ms']
             )
+        if settings['buffer']:
+            kwargs['buffer_size'] = settings['buffer']
+        try:
+            c24session.pcap_sess = c24session.fpcapt.pcap(**kwargs)
+        except TypeError:
+            if kwargs.pop('buffer_size', None) is None:
+                raise
+            LOG.warn('This pypcap can not set the capture buffer size, using the default')
+            c24session.pcap_sess = c24session.fpcapt.pcap(**kwargs)
+        LOG.info('Capture immediate:%s timeout:%dms buffer:%s', settings['immediate'],
+                 settings['timeout_ms'], settings['buffer'] or 'default')
         filtstr = PCAP_FILTER % c24session.mac_computer_str
         c24session.pcap_sess.setfilter(filtstr)
+        c24session.capture_filter = filtstr
         c24session.is_capturing = True
         self.pcap_sess = c24session.pcap_sess
         self.packet_handler = c24session.packet_handler
@@ -273,6 +379,73 @@ class Sniffer(threading.Thread):
         except KeyboardInterrupt:
             C24session.is_capturing = False
 
+class PcapStats(object):
+    """Packets the capture received and dropped, as libpcap counts
+    them. Shared with the daemon when a capture process keeps them"""
+    def __init__(self, shared):
+        if shared:
+            self.counts = multiprocessing.RawArray(c_uint32, 3)
+        else:
+            self.counts = (c_uint32 * 3)()
+
+    def __str__(self):
+        return 'pcap recv:{} drop:{} ifdrop:{}'.format(*self.counts)
+
+
+class DeskCounts(Structure):
+    """Counts kept by whichever process handles the packets from a
+    desk. Shared with the daemon when a capture process keeps them"""
+    _fields_ = [
+        ("packets_in", c_uint32),
+        ("acks_out", c_uint32),
+        ("retries", c_uint32),
+        ("acks_late", c_uint32),
+        ("busy", c_double)
+    ]
+
+
+class CaptureMonitor(threading.Thread):
+    """Thread class to look after the capture now and then. Reads the
+    capture statistics and warns when the capture drops packets, more
+    so if the desk has been sending retries at the same time, as that
+    is the likely cause. Also widens the filter again if a desk is lost"""
+    def __init__(self, session):
+        super(CaptureMonitor, self).__init__()
+        self.daemon = True
+        self.name = 'thread_capture_monitor'
+        self.session = session
+
+    def run(self):
+        """monitor loop"""
+        counts = self.session.pcap_stats.counts
+        last_retries = 0
+        has_stats = True
+        while not self.session.is_closing:
+            time.sleep(TIMING_PCAP_STATS)
+            self.session.update_filter()
+            if not has_stats:
+                continue
+            try:
+                stats = self.session.pcap_sess.stats()
+            except (AttributeError, OSError) as err:
+                LOG.warn('Capture statistics not available: %s', err)
+                has_stats = False
+                continue
+            drops = [now - before for now, before in zip(stats[1:3], counts[1:3])]
+            counts[0], counts[1], counts[2] = stats[:3]
+            retries = sum(desk.counts.retries for desk in self.session.desklinks)
+            new_retries, last_retries = retries - last_retries, retries
+            if not any(drops):
+                continue
+            if new_retries:
+                LOG.warn('Capture dropped %d packets, interface %d, and the desk sent '
+                         '%d retries in the last %ds. Try a bigger --pcap-buffer',
+                         drops[0], drops[1], new_retries, TIMING_PCAP_STATS)
+            else:
+                LOG.warn('Capture dropped %d packets, interface %d, in the last %ds',
+                         drops[0], drops[1], TIMING_PCAP_STATS)
+
+
 class KeepAlive(threading.Thread):
     """Thread class to hold the keep alive loop"""
     def __init__(self, session):
@@ -283,20 +456,283 @@ class KeepAlive(threading.Thread):
         self.session = session
 
     def run(self):
-        """keep alive loop"""
+        """keep alive loop, which also logs the session statistics"""
+        last_stats = tick()
         while not self.session.is_closing:
-            if self.session.is_capturing and not self.session.mac_control24 is None:
-                delta = tick() - self.session.pcap_last_sent
-                if delta >= TIMING_KEEP_ALIVE:
-                    LOG.debug('TODESK KeepAlive')
-                    self.session.send_packet(self.session.prepare_keepalive())
+            for desk in self.session.desklinks:
+                if self.session.is_capturing and not desk.mac_control24 is None:
+                    delta = tick() - desk.pcap_last_sent
+                    if delta >= TIMING_KEEP_ALIVE:
+                        LOG.debug('TODESK %d KeepAlive', desk.index)
+                        desk.send_keepalive()
+            if tick() - last_stats >= TIMING_STATS:
+                last_stats = tick()
+                self.session.log_stats()
             time.sleep(TIMING_KEEP_ALIVE_LOOP)
 
+class ShmRing(object):
+    """Ring of fixed size slots in shared memory to pass desk frames
+    from the capture process to the daemon. One producer, one consumer.
+    The producer never blocks, if the ring is full the frame is dropped
+    and counted"""
+    slot_head = 4                       # 2 bytes length, 1 byte kind, 1 byte desk
+    slot_size = PCAP_SNAPLEN + slot_head
+
+    def __init__(self, slots=RING_SLOTS):
+        self.slots = slots
+        self.buf = multiprocessing.RawArray(c_ubyte, slots * self.slot_size)
+        self.head = multiprocessing.RawValue(c_uint32, 0)
+        self.tail = multiprocessing.RawValue(c_uint32, 0)
+        self.dropped = multiprocessing.RawValue(c_uint32, 0)
+        self.avail = multiprocessing.Semaphore(0)
+
+    def put(self, kind, desk, data, size):
+        """producer side, copy the data into the next slot"""
+        head = self.head.value
+        if (head - self.tail.value) & 0xFFFFFFFF >= self.slots:
+            self.dropped.value += 1
+            return False
+        offset = (head % self.slots) * self.slot_size
+        self.buf[offset] = size >> 8
+        self.buf[offset + 1] = size & 0xFF
+        self.buf[offset + 2] = kind
+        self.buf[offset + 3] = desk
+        memmove(addressof(self.buf) + offset + self.slot_head, data, size)
+        self.head.value = head + 1
+        self.avail.release()
+        return True
+
+    def get(self, timeout):
+        """consumer side, return kind, desk and data or None if timed out"""
+        if not self.avail.acquire(True, timeout):
+            return None
+        tail = self.tail.value
+        offset = (tail % self.slots) * self.slot_size
+        size = (self.buf[offset] << 8) + self.buf[offset + 1]
+        kind = self.buf[offset + 2]
+        desk = self.buf[offset + 3]
+        data = string_at(addressof(self.buf) + offset + self.slot_head, size)
+        self.tail.value = tail + 1
+        return kind, desk, data
+
+
+class CaptureProcess(multiprocessing.Process):
+    """Process to hold the packet capture loop and ACK generation,
+    away from the GIL of the main daemon process. Desk data is
+    handed back through a shared memory ring"""
+    def __init__(self, session, opts):
+        super(CaptureProcess, self).__init__()
+        self.daemon = True
+        self.name = 'process_capture'
+        self.network = session.network
+        self.mac_computer_str = session.mac_computer_str
+        self.ring = session.ring
+        self.pcap_settings = session.pcap_settings
+        self.pcap_stats = session.pcap_stats
+        self.sendlocks = [desk.sendlock for desk in session.desklinks]
+        self.counts = [desk.counts for desk in session.desklinks]
+        self.logdir = opts.logdir
+        self.debug = opts.debug
+
+    def run(self):
+        """start logging for this process and run the pcap loop"""
+        global LOG, TRACE
+        LOG = start_logging('control24cap', self.logdir, self.debug)
+        TRACE = tracing(LOG)
+        capture = C24capture(self)
+        CaptureMonitor(capture).start()
+        capture.thread_pcap_loop.run()
+
+
+class RingReader(threading.Thread):
+    """Thread class to take frames out of the capture ring
+    and handle them in the main daemon process"""
+    def __init__(self, session):
+        """set up the thread and copy session refs needed"""
+        super(RingReader, self).__init__()
+        self.daemon = True
+        self.name = 'thread_ring_reader'
+        self.session = session
+        self.ring = session.ring
+
+    def run(self):
+        """ring reader loop"""
+        while not self.session.is_closing:
+            slot = self.ring.get(TIMING_RING_POLL)
+            if slot is None:
+                continue
+            kind, index, data = slot
+            desk = self.session.desklinks[index]
+            if kind == RING_DESKDATA:
+                self.session.forward_desk_data(desk, data)
+            elif kind == RING_DISCOVERY:
+                macsrc = MacAddress.from_buffer_copy(data[:6])
+                self.session.desk_detected(
+                    macsrc, data[15:24].rstrip('\x00'), data[6:15].rstrip('\x00'), desk)
+
+
+class MPClient(object):
+    """One connected client of the daemon. Desk data is queued to it
+    without blocking so a slow client can't hold up the desk, and its
+    commands are queued for the DeskSender to merge with the others"""
+    def __init__(self, listener, conn, address):
+        self.listener = listener
+        self.session = listener.session
+        self.conn = conn
+        self.address = address
+        self.subscribed = None      # None means everything
+        self.desk = self.session.desklinks[0]
+        self.outbound = Queue.Queue(MP_QUEUE_SIZE)
+        self.inbound = ClassQueue(MP_QUEUE_SIZE)
+        self.carry = None
+        self.is_connected = True
+        self.dropped = 0
+        self.dropping = False
+        self.thread_reader = threading.Thread(
+            target=self._reader, name='thread_client_reader')
+        self.thread_reader.daemon = True
+        self.thread_writer = threading.Thread(
+            target=self._writer, name='thread_client_writer')
+        self.thread_writer.daemon = True
+
+    def __str__(self):
+        rtt = getattr(self.conn, 'rtt', None)
+        return 'client {} desk:{} subscribed:{} queued:{} dropped:{}{} waits {}'.format(
+            self.address,
+            self.desk.index,
+            'all' if self.subscribed is None else hexl(bytearray(self.subscribed)),
+            self.outbound.qsize(),
+            self.dropped,
+            '' if rtt is None else ' rtt:{:.2f}ms'.format(rtt * 1000),
+            self.inbound)
+
+    def start(self):
+        """start the reader and writer threads, and tell
+        the client if its desk is already online. A client in this
+        process hands its commands straight to receive, so needs
+        no reader"""
+        if isinstance(self.conn, LocalConnection):
+            self.conn.deliver(self.receive)
+        else:
+            self.thread_reader.start()
+        self.thread_writer.start()
+        if self.desk.is_online():
+            self.send_control(MP_ONLINE)
+
+    def send_control(self, msg):
+        """queue a control message for the client, whatever
+        it subscribes to"""
+        try:
+            self.outbound.put_nowait(msg)
+        except Queue.Full:
+            LOG.warn('MP client %s not keeping up, control message dropped', self.address)
+
+    def offer(self, pkt_data):
+        """queue desk data for this client if it subscribes to
+        any of it, drop it if the client is not keeping up"""
+        if not self.subscribed is None:
+            pkt_data = ''.join(cmd for cmd in split_commands(pkt_data)
+                               if ord(cmd[0]) in self.subscribed)
+            if not pkt_data:
+                return
+        try:
+            self.outbound.put_nowait(pkt_data)
+            self.dropping = False
+        except Queue.Full:
+            self.dropped += 1
+            if not self.dropping:
+                LOG.warn('MP client %s not keeping up, dropping desk data', self.address)
+                self.dropping = True
+
+    def next_command(self, room, cmds_room):
+        """return the next command, or batch of them, from this client
+        as (number of commands, bytes) if there is one and it fits
+        in the room left"""
+        if self.carry is None:
+            try:
+                self.carry = self.inbound.get_nowait()[1]
+            except Queue.Empty:
+                return None
+        if len(self.carry[1]) > room or self.carry[0] > cmds_room:
+            return None
+        cmd, self.carry = self.carry, None
+        return cmd
+
+    def control(self, msg):
+        """act on a control message from the client"""
+        if msg[:2] == MP_SUBSCRIBE:
+            cmdbytes = frozenset(ord(byt) for byt in msg[2:])
+            self.subscribed = cmdbytes or None
+            LOG.info('MP %s', self)
+        elif msg[:2] == MP_BATCH:
+            # commands to go in the same desk packet
+            self.inbound.put(classify(msg), (ord(msg[2]), msg[3:]))
+            self.desk.send_pending.set()
+        elif msg[:2] == MP_DESK:
+            index = ord(msg[2])
+            if index < len(self.session.desklinks):
+                self.desk = self.session.desklinks[index]
+                LOG.info('MP %s', self)
+                if self.desk.is_online():
+                    self.send_control(MP_ONLINE)
+            else:
+                LOG.warn('MP client %s asked for desk %d but only %d are served',
+                         self.address, index, len(self.session.desklinks))
+        else:
+            LOG.warn('MP client %s unknown control message %s', self.address, hexl(msg))
+
+    def disconnect(self):
+        """close down and leave the listener"""
+        if self.is_connected:
+            self.is_connected = False
+            LOG.info('MP Listener disconnected from %s', self.address)
+            self.conn.close()
+            try:
+                self.outbound.put_nowait(None)
+            except Queue.Full:
+                pass
+            self.listener.remove_client(self)
+
+    def receive(self, msg):
+        """queue a command from the client for its desk, or act
+        on a control message. None means the client has gone"""
+        if msg is None:
+            self.disconnect()
+        elif msg[:1] == MP_CONTROL:
+            self.control(msg)
+        else:
+            # block when full, so a flooding client is held back,
+            # unless the command's class would rather drop
+            self.inbound.put(classify(msg), (1, msg), command_key(msg))
+            self.desk.send_pending.set()
+
+    def _reader(self):
+        """client to desk loop"""
+        while self.is_connected:
+            try:
+                msg = self.conn.recv_bytes()
+            except (EOFError, IOError):
+                self.disconnect()
+                break
+            self.receive(msg)
+
+    def _writer(self):
+        """desk to client loop"""
+        while self.is_connected:
+            pkt_data = self.outbound.get()
+            if pkt_data is None:
+                break
+            try:
+                self.conn.send_bytes(pkt_data)
+            except (IOError, EOFError):
+                # Client broke the pipe?
+                LOG.info('MP Listener broken pipe from %s', self.address)
+                self.disconnect()
+
+
 class ManageListener(threading.Thread):
-    """Thread class to manage the multiprocessing listener"""
-    #multiprocessing parameters
-    cmd_buffer_length = 314
-    max_cmds_in_packet = 48
+    """Thread class to manage the multiprocessing listener
+    and the clients that connect to it"""
 
     def __init__(self, session):
         """set up the thread and copy session refs needed"""
@@ -305,266 +741,584 @@ class ManageListener(threading.Thread):
         self.name = 'thread_listener'
         self.session = session
         self.mp_listener = self.session.mp_listener
-        self.mp_conn = None
+        self.clients = []
+        self.clients_lock = threading.Lock()
 
     def run(self):
         """listener management loop"""
-        # Start a Multprocessing Listener
-        self.mp_listener = Listener(
-            self.session.listen_address, authkey=DEFAULTS.get('auth'))
-        recvbuffer = create_string_buffer(self.cmd_buffer_length)
-        # Loop to manage connect/disconnect events
+        # Start a Multprocessing or remote link Listener, unless the
+        # client lives in this process and a local connection is supplied
+        if not self.session.local_conn is None:
+            pass
+        elif self.session.transport == 'link':
+            self.mp_listener = LinkListener(
+                self.session.listen_address, DEFAULTS.get('auth'))
+        else:
+            self.mp_listener = Listener(
+                self.session.listen_address, authkey=DEFAULTS.get('auth'))
+        # Loop to accept clients, which then run in their own threads
         while not self.session.is_closing:
             last = None
             try:
-                LOG.info('MP Listener waiting for connection at %s',
-                         self.session.listen_address)
-                self.mp_conn = self.mp_listener.accept()
-                self.session.mp_is_connected = True
-                last = self.mp_listener.last_accepted
+                conn, last = self._accept()
                 LOG.info('MP Listener Received connection from %s', last)
-                while self.session.mp_is_connected:
-                    buffsz = 0
-                    if self.mp_conn.poll(TIMING_LISTENER_POLL):
-                        incrsz = self.mp_conn.recv_bytes_into(
-                            recvbuffer, buffsz)
-                        buffsz += incrsz
-                        ncmds = 1
-                        while all([
-                                self.mp_conn.poll(),
-                                ncmds < self.max_cmds_in_packet,
-                                buffsz < self.cmd_buffer_length - 30
-                            ]):
-                            incrsz = self.mp_conn.recv_bytes_into(
-                                recvbuffer, buffsz)
-                            buffsz += incrsz
-                            ncmds += 1
-                        self.session.receive_handler(recvbuffer.raw, ncmds, buffsz)
-
+                client = MPClient(self, conn, last)
+                with self.clients_lock:
+                    self.clients.append(client)
+                    self.session.mp_is_connected = True
+                client.start()
+                if not self.session.local_conn is None:
+                    # The in-process client is the only one
+                    break
             except AuthenticationError:
                 LOG.warn('MP Listener Authentication Error connection from %s',
                          last)
-                self.session.mp_is_connected = False
-                time.sleep(TIMING_LISTENER_RECONNECT)
             except (EOFError, IOError):
-                LOG.info('MP Listener disconnected from %s', last)
-                self.session.mp_is_connected = False
+                if self.session.is_closing:
+                    break
+                LOG.info('MP Listener failed connection from %s', last)
                 time.sleep(TIMING_LISTENER_RECONNECT)
             except Exception:
+                if self.session.is_closing:
+                    break
                 LOG.error("MP Listener Uncaught exception", exc_info=True)
                 raise
 
-        # close down gracefully
-        if self.session.mp_is_connected:
-            LOG.info('MP Listener closing connection with %s', last)
-            self.mp_conn.close()
-            self.session.mp_is_connected = False
-        self.mp_listener.close()
-
-    def mpsend(self, pkt_data):
-        """If a client is connected then send the data to it.
-        trap if this sees that the client went away meanwhile"""
-        if not self.mp_conn is None:
-            try:
-                self.mp_conn.send_bytes(pkt_data)
-            except (IOError, EOFError):
-                # Client broke the pipe?
-                LOG.info('MP Listener broken pipe from %s',
-                         self.mp_listener.last_accepted)
-                self.mp_conn.close()
-                self.session.mp_is_connected = False
-                self.mp_conn = None
+    def _accept(self):
+        """Wait for a client and return its connection and address.
+        An in-process client is already connected so is used as-is"""
+        if not self.session.local_conn is None:
+            return self.session.local_conn, 'local'
+        LOG.info('MP Listener waiting for connection at %s',
+                 self.session.listen_address)
+        conn = self.mp_listener.accept()
+        return conn, self.mp_listener.last_accepted
+
+    def remove_client(self, client):
+        """forget a client that has gone"""
+        with self.clients_lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            self.session.mp_is_connected = bool(self.clients)
+
+    def client_list(self, desk=None):
+        """a copy of the clients, or those of one desk, taken under
+        the lock so clients may come and go while it is used"""
+        with self.clients_lock:
+            return [client for client in self.clients
+                    if desk is None or client.desk is desk]
+
+    def notify_online(self, desk):
+        """Tell every client of the desk it has come online"""
+        for client in self.client_list(desk):
+            client.send_control(MP_ONLINE)
+
+    def mpsend(self, desk, pkt_data):
+        """Offer the data to every client connected to the desk.
+        Never blocks"""
+        if not isinstance(pkt_data, str):
+            pkt_data = str(bytearray(pkt_data))
+        for client in self.client_list(desk):
+            client.offer(pkt_data)
 
-# Main sesssion class
-class C24session(object):
-    """Class to contain all session details with the Control24.
-    Only 1 session is expected"""
+    def close(self):
+        """close down the clients and the listener"""
+        for client in self.client_list():
+            LOG.info('MP Listener closing connection with %s', client.address)
+            client.disconnect()
+        if not self.mp_listener is None:
+            self.mp_listener.close()
+
+
+class DeskSender(threading.Thread):
+    """Thread class to merge commands from all clients of a desk
+    into packets for it, taking one from each client in turn"""
+    #multiprocessing parameters
+    cmd_buffer_length = 314
+    max_cmds_in_packet = 48
+
+    def __init__(self, session, desk):
+        """set up the thread and copy session refs needed"""
+        super(DeskSender, self).__init__()
+        self.daemon = True
+        self.name = 'thread_desk_sender_{}'.format(desk.index)
+        self.session = session
+        self.desk = desk
+
+    def run(self):
+        """desk sender loop"""
+        while not self.session.is_closing:
+            # clear before looking, so a command queued
+            # after the look will still wake us
+            self.desk.send_pending.clear()
+            clients = self.session.thread_listener.client_list(self.desk)
+            ncmds, cmds = self.gather(clients)
+            if cmds:
+                self.desk.receive_handler(cmds, ncmds)
+            else:
+                self.desk.send_pending.wait(TIMING_LISTENER_POLL)
+
+    def gather(self, clients):
+        """round robin the clients for commands until
+        the packet is full or there are no more"""
+        cmds = []
+        ncmds = 0
+        room = self.cmd_buffer_length - 30
+        more = True
+        while more:
+            more = False
+            for client in clients:
+                cmd = client.next_command(room, self.max_cmds_in_packet - ncmds)
+                if not cmd is None:
+                    ncmds += cmd[0]
+                    cmds.append(cmd[1])
+                    room -= len(cmd[1])
+                    more = True
+                    if ncmds >= self.max_cmds_in_packet:
+                        return ncmds, cmds
+        return ncmds, cmds
+
+
+class C24desklink(object):
+    """State of the session with one desk: its address,
+    sequence counters, send lock and statistics"""
 
     c24cmds = COMMANDS
-    # callbacks / event handlers (threaded)
-    def packet_handler(self, timestamp, pkt_data):
-        """PCAP Packet Handler: Async method called on packet capture"""
-        broadcast = False
-        pkt_len = len(pkt_data)
-        # build a dynamic class and load the data into it
-        pcl = c24packet_factory(prm_tot_len=pkt_len)
-        packet = pcl()
-        packet = pcl.from_buffer_copy(pkt_data)
-        #Detailed traffic logging
-        LOG.debug('Packet Received: %s', str(packet))
-        # Decode any broadcast packets
-        if packet.is_broadcast():
-            broadcast = True
-            pbp = POINTER(C24BcastData)
-            bcast_data = cast(packet.struc.packetdata, pbp).contents
-            LOG.debug('%s', str(bcast_data))
+
+    def __init__(self, session, index, sendlock, counts=None):
+        self.session = session
+        self.index = index
+        self.mac_control24 = None
+        self.device = None
+        # build a re-usable Ethernet Header for sending packets
+        self.ethheader = EthHeader()
+        self.ethheader.macsrc = session.mac_computer
+        # and re-usable packets with it in place, one per data length,
+        # plus one for ACKs which only the packet handler sends
+        self.packets = {}
+        self.packet_lock = threading.Lock()
+        self.ack_packet = None
+        # desk-to-daw (cmdcounter) and daw-to-desk (sendcounter)
+        self.cmdcounter = 0
+        self.sendcounter = 1
+        self.sendlock = sendlock
+        self.sendlock.set()
+        self.send_pending = threading.Event()
+        self.backoff = None
+        self.current_retry_desk = 0
+        self.pcap_last_sent = tick()
+        self.last_heard = tick()
+        # statistics, those of the packet handler in counts
+        self.counts = DeskCounts() if counts is None else counts
+        self.packets_out = 0
+        self.busy = 0.0
+
+    def __str__(self):
+        """pretty print desk state if requested"""
         if self.mac_control24 is None:
-            macsrc = packet.struc.ethheader.macsrc
-            if broadcast and macsrc.is_vendor():
-                LOG.info('Desk detected: %s %s at %s',
-                         bcast_data.device,
-                         bcast_data.version,
-                         hexl(macsrc)
-                        )
-                # copy the mac address from the packet to the session
-                self.mac_control24 = MacAddress.from_buffer_copy(macsrc)
-                self.ethheader.macdest = self.mac_control24
-                # initialise the desk by sending the init command
-                # and wiping the clock display
-                init1 = self._prepare_packetr(None, 0, 0, c24cmd=COMMANDS['online'])
-                init2data = (c_ubyte * 15)(0xF0, 0x13, 0x01, 0x30, 0x19, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0xf7)
-                init2 = self._prepare_packetr(init2data, 15, 1, (c_ubyte * 2)(0x02, 0x44))
-                self.send_packet(init1)
-                self.send_packet(init2)
+            return 'desk {}: not detected'.format(self.index)
+        return 'desk {}: {} at {} in:{} out:{} retries:{} acks late:{} busy:{:.3f}s'.format(
+            self.index,
+            self.device,
+            hexl(self.mac_control24),
+            self.counts.packets_in,
+            self.packets_out + self.counts.acks_out,
+            self.counts.retries,
+            self.counts.acks_late,
+            self.busy + self.counts.busy)
+
+    def detected(self, macsrc, device):
+        """take the address of the desk from its broadcast.
+        A desk starting over expects the counters to start over too"""
+        self.mac_control24 = MacAddress.from_buffer_copy(macsrc)
+        self.ethheader.macdest = self.mac_control24
+        with self.packet_lock:
+            self.packets = {}
+        self.ack_packet = self._template(0)
+        self.device = device
+        self.cmdcounter = 0
+        self.sendcounter = 1
+        if not self.backoff is None:
+            self.backoff.cancel()
+        self.sendlock.set()
+        self.last_heard = tick()
+
+    def is_online(self):
+        """True once the desk has been detected"""
+        return not self.mac_control24 is None
+
+    def is_silent(self):
+        """True if nothing has been heard from the desk for a while"""
+        return tick() - self.last_heard > TIMING_DESK_SILENT
+
+    def bring_online(self):
+        """initialise the desk by sending the init command
+        and wiping the clock display"""
+        init2data = '\xF0\x13\x01\x30\x19\x00\x00\x00\x00\x00\x00\x00\x00\x00\xf7'
+        self._send_data((), 0, 0, c24cmd=COMMANDS['online'])
+        self._send_data((init2data, ), 15, 1, '\x02\x44')
+
+    def packet_handler(self, timestamp, sendcounter, retry, c24cmd, numcommands, pkt_data):
+        """Handle a non broadcast packet from this desk, with the
+        header fields already unpacked from the raw packet data"""
+        self.counts.packets_in += 1
+        self.last_heard = timestamp
+        # Look first to see if this is an ACK
+        if c24cmd == COMMANDS['ack']:
+            if TRACE:
+                LOG.debug('FROMDESK %d ACK', self.index)
+            if not self.backing_off():
+                self.sendlock.set()
         else:
-            if pkt_len > 30 and not broadcast:
-                # Look first to see if this is an ACK
-                if packet.struc.c24header.c24cmd == COMMANDS['ack']:
-                    LOG.debug('FROMDESK ACK')
-                    if not self.backoff.is_alive():
-                        self.sendlock.set()
+            # At this point an ACK is pending so lock all sending
+            self.sendlock.clear()
+            # Check to see if this is retry
+            if retry:
+                self.current_retry_desk = retry
+                self.counts.retries += 1
+                LOG.warn('Retry packets from desk %d: %d', self.index, retry)
+                # Try a send lock if desk is panicking, back off for a
+                # bit of time to let 'er breathe
+                self.sendlock.clear()
+                if self.backoff is None:
+                    self.backoff = get_scheduler(LOG).call_later(
+                        TIMING_BACKOFF, self._backoff)
                 else:
-                    # At this point an ACK is pending so lock all sending
-                    self.sendlock.clear()
-                    # Check to see if this is retry
-                    if packet.is_retry():
-                        self.current_retry_desk = retry = packet.struc.c24header.retry
-                        LOG.warn('Retry packets from desk: %d', retry)
-                        # Try a send lock if desk is panicking, back off for a
-                        # bit of time to let 'er breathe
-                        self.sendlock.clear()
-                        self.backoff = threading.Timer(TIMING_BACKOFF, self._backoff)
-                        self.backoff.start()
-                    if packet.struc.c24header.numcommands > 0:
-                        cmdnumber = packet.struc.c24header.sendcounter
-                        LOG.debug('FROMDESK %d', cmdnumber)
-                        # this counter changes to the value the DESK sends to us so we can ACK it
-                        self.cmdcounter = cmdnumber
-                        # forward it to the Multiprocessing clients
-                        self.thread_listener.mpsend(packet.struc.packetdata)
-                        LOG.debug('TODESK ACK: %d', self.cmdcounter)
-                        time.sleep(TIMING_BEFORE_ACKT)
-                        self.send_packet(self._prepare_ackt())
-                        if not self.backoff.is_alive():
-                            self.sendlock.set()
-                    else:
-                        LOG.warn('FROMDESK unhandled :%02x', packet.struc.packetdata[0])
-                        LOG.debug('     unhandled: %s', hexl(packet.raw))
-
-    def receive_handler(self, buff, ncmds, buffsz):
-        LOG.debug('MP recv: c:%d s:%d d:%s', ncmds, buffsz,
-                  hexl(buff[:buffsz]))
-        pkt_data_len = buffsz  # len(buff)
-        pkt_data = (c_ubyte * pkt_data_len).from_buffer_copy(buff)
+                    self.backoff.reschedule(TIMING_BACKOFF)
+            if numcommands > 0:
+                if TRACE:
+                    LOG.debug('FROMDESK %d %d', self.index, sendcounter)
+                # this counter changes to the value the DESK sends to us so we can ACK it
+                self.cmdcounter = sendcounter
+                # forward it to the Multiprocessing clients, unless it is
+                # a keepalive, which the clients map to nothing anyway
+                if pkt_data[PKT_HEADER_LEN] != '\x00':
+                    self.session.forward_desk_data(self, pkt_data[PKT_HEADER_LEN:])
+                if TRACE:
+                    LOG.debug('TODESK %d ACK: %d', self.index, self.cmdcounter)
+                time.sleep(TIMING_BEFORE_ACKT)
+                self._send_ack()
+                ack_delta = tick() - timestamp
+                if ack_delta > TIMING_ACK_DEADLINE:
+                    self.counts.acks_late += 1
+                    LOG.warn('ACK to desk %d late by %.4f', self.index, ack_delta)
+                if not self.backing_off():
+                    self.sendlock.set()
+            else:
+                LOG.warn('FROMDESK unhandled :%02x', ord(pkt_data[PKT_HEADER_LEN]))
+                LOG.debug('     unhandled: %s', LazyHex(pkt_data))
+
+    def receive_handler(self, cmds, ncmds):
+        """Send commands from the clients on to this desk"""
+        started = tick()
+        buffsz = sum(len(cmd) for cmd in cmds)
+        if TRACE:
+            LOG.debug('MP recv: c:%d s:%d d:%s', ncmds, buffsz, hexl(''.join(cmds)))
         totalwait = 0.0
+        waiting = tick()
         while not self.sendlock.wait(TIMING_WAIT_DESC_ACK):
             totalwait += TIMING_WAIT_DESC_ACK
-            LOG.warn('Waiting for DESK ACK %d', totalwait)
+            LOG.warn('Waiting for DESK %d ACK %d', self.index, totalwait)
             #TODO implement daw-desk retry packets
-        LOG.debug('TODESK CMD %d', self.sendcounter)
+        # Waiting for the ACK is idle time, so it is not counted as busy
+        started += tick() - waiting
+        if TRACE:
+            LOG.debug('TODESK %d CMD %d', self.index, self.sendcounter)
         if not self.mac_control24 is None:
-            packet = self._prepare_packetr(pkt_data, pkt_data_len, ncmds)
-            self.send_packet(packet)
+            self._send_data(cmds, buffsz, ncmds)
             self.sendlock.clear()
         else:
             LOG.warn(
                 'MP received but no desk to send to. Establish a session. %s',
-                hexl(pkt_data))
+                hexl(''.join(cmds)))
+        self.busy += tick() - started
 
-    # session instance methodsk0
-    def send_packet(self, pkt):
-        """sesion wrapper around pcap_sendpacket
-        so we can pass in session and trap error"""
-        LOG.debug("Sending Packet of %d bytes: %s", pkt.pkt_tot_len, hexl(pkt.raw))
-        buf = pkt.to_buffer()
-        pcap_status = self.pcap_sess.sendpacket(buf)
-        if pcap_status != pkt.pkt_tot_len:
-            LOG.warn("Error sending packet: %s", self.pcap_sess.geterr())
-        else:
+    def send_packet(self, buf):
+        """send to this desk and note the time,
+        returns True if it was sent"""
+        if self.session.send_packet(buf):
             self.pcap_last_sent = tick()
-            self.pcap_last_packet = pkt
-
-    def _prepare_packetr(self, pkt_data, pkt_data_len, ncmds, parity=None, c24cmd=None):
-        """session wrapper around C24Packet"""
-        if parity is None:
-            parity = (c_ubyte * 2)()
-        pcp = c24packet_factory(prm_data_len=pkt_data_len)()
-        pcp.struc.ethheader = self.ethheader
-        pcp.struc.c24header.unknown1 = parity
-        if c24cmd:
-            pcp.struc.c24header.c24cmd = c24cmd
-        if pkt_data_len > 0:
-            pcp.struc.packetdata = pkt_data
-        pcp.struc.c24header.numcommands = ncmds
-        if c24cmd == self.c24cmds['ack']:
-            pcp.struc.c24header.cmdcounter = self.cmdcounter
-        else:
+            return True
+        return False
+
+    def _template(self, data_len):
+        """a packet with room for data_len bytes of
+        data, the ethernet header already in place"""
+        buf = bytearray(PKT_HEADER_LEN + data_len)
+        buf[:ETH_HEADER_LEN] = string_at(addressof(self.ethheader), ETH_HEADER_LEN)
+        return buf
+
+    def _send_data(self, cmds, data_len, ncmds, parity=PARITY_NONE, c24cmd=0):
+        """Fill in the re-usable packet for the data length and send it.
+        The commands are copied straight into it, which is the only copy"""
+        with self.packet_lock:
+            buf = self.packets.get(data_len)
+            if buf is None:
+                buf = self.packets[data_len] = self._template(data_len)
             # This counter increments by number of commands we are sending in this/each packet
             self.sendcounter += ncmds
-            pcp.struc.c24header.sendcounter = self.sendcounter
-        return pcp
-
-    def prepare_keepalive(self):
-        """session wrapper around keepalive packet"""
-        keepalivedata = (c_ubyte * 1)()
-        keepalive = self._prepare_packetr(keepalivedata, 1, 1)
-        return keepalive
-
-    def _prepare_ackt(self):
-        """session wrapper around ackt packet"""
-        ack = self._prepare_packetr(None, 0, 0, c24cmd=self.c24cmds['ack'])
-        return ack
+            PKT_FIELDS.pack_into(buf, ETH_HEADER_LEN, data_len + 16, parity,
+                                 self.sendcounter, 0, 0, c24cmd, ncmds)
+            psn = PKT_HEADER_LEN
+            for cmd in cmds:
+                buf[psn:psn + len(cmd)] = cmd
+                psn += len(cmd)
+            if self.send_packet(buf):
+                self.packets_out += 1
+
+    def send_keepalive(self):
+        """send a single null command, to keep the desk online"""
+        self._send_data(('\x00', ), 1, 1)
+
+    def _send_ack(self):
+        """ACK the last command packet from the desk"""
+        PKT_FIELDS.pack_into(self.ack_packet, ETH_HEADER_LEN, 16, PARITY_NONE,
+                             0, self.cmdcounter, 0, self.c24cmds['ack'], 0)
+        if self.send_packet(self.ack_packet):
+            self.counts.acks_out += 1
+
+    def backing_off(self):
+        """True while sending is held off after desk retries"""
+        return not self.backoff is None and self.backoff.active()
 
     def _backoff(self):
         LOG.debug('backoff complete')
         self.sendlock.set()
 
-    def __init__(self, opts, networks):
-        """Constructor to build the session object"""
-        global LOG
+
+# Main sesssion class
+class C24session(object):
+    """Class to contain all session details with the Control24s.
+    Only 1 session is expected, serving up to opts.desks desks"""
+
+    # callbacks / event handlers (threaded)
+    def packet_handler(self, timestamp, pkt_data):
+        """PCAP Packet Handler: Async method called on packet capture.
+        Packets are sorted on the raw header fields, only broadcasts
+        are decoded into the ctypes structures, or all when debugging"""
+        started = tick()
+        pkt_len = len(pkt_data)
+        if pkt_len < PKT_HEADER_LEN:
+            return
+        macdest, macsrc, sendcounter, __, retry, c24cmd, numcommands = \
+            PKT_HEADER.unpack_from(pkt_data)
+        #Detailed traffic logging
+        if TRACE:
+            packet = c24packet_factory(prm_tot_len=pkt_len).from_buffer_copy(pkt_data)
+            LOG.debug('Packet Received: %s', packet)
+        # Demultiplex by the sending desk
+        desk = self.desks.get(macsrc)
+        if macdest == MAC_BROADCAST:
+            # Decode the broadcast, padded in case it is short
+            bcast_data = C24BcastData.from_buffer_copy(
+                pkt_data[PKT_HEADER_LEN:].ljust(sizeof(C24BcastData), '\x00'))
+            LOG.debug('%s', bcast_data)
+            if desk is None:
+                if macsrc.startswith(MAC_VENDOR):
+                    self.desk_detected(MacAddress.from_buffer_copy(macsrc),
+                                       bcast_data.device, bcast_data.version)
+            # A desk only broadcasts until it is brought online
+            elif desk.is_silent():
+                LOG.warn('Desk %d is broadcasting again, it may have restarted', desk.index)
+                self.desk_detected(MacAddress.from_buffer_copy(macsrc),
+                                   bcast_data.device, bcast_data.version, desk)
+        elif not desk is None and pkt_len > PKT_HEADER_LEN:
+            desk.packet_handler(timestamp, sendcounter, retry, c24cmd, numcommands, pkt_data)
+            desk.counts.busy += tick() - started
+
+    def free_desk(self):
+        """return the first desk link not yet detected, if any"""
+        for desk in self.desklinks:
+            if desk.mac_control24 is None:
+                return desk
+        return None
+
+    def lost_desk(self):
+        """return the first desk link not heard from for a long
+        time, if any, which a new desk may take over"""
+        lost = tick() - TIMING_DESK_LOST
+        for desk in self.desklinks:
+            if desk.last_heard < lost:
+                return desk
+        return None
+
+    def take_desk(self, desk, macsrc, device):
+        """copy the mac address from the packet to the desk link,
+        in place of any desk it had before"""
+        if desk.is_online():
+            self.desks.pop(string_at(addressof(desk.mac_control24), 6), None)
+        desk.detected(macsrc, device)
+        self.desks[string_at(addressof(desk.mac_control24), 6)] = desk
+
+    def desk_detected(self, macsrc, device, version, desk=None):
+        """A desk broadcast was seen, take its address
+        and bring it online"""
+        if desk is None:
+            desk = self.free_desk() or self.lost_desk()
+        if desk is None:
+            LOG.debug('Desk at %s ignored, already serving %d',
+                      hexl(macsrc), len(self.desklinks))
+            return
+        LOG.info('Desk %d detected: %s %s at %s',
+                 desk.index,
+                 device,
+                 version,
+                 hexl(macsrc)
+                )
+        self.take_desk(desk, macsrc, device)
+        desk.bring_online()
+        self.thread_listener.notify_online(desk)
+        self.update_filter()
+
+    def update_filter(self):
+        """Once every desk is found, capture only what they send, so
+        other traffic is dropped in the kernel. Until then, or if a desk
+        has been lost, capture any broadcast that may be a desk"""
+        if self.capture_filter is None:
+            return
+        lost = tick() - TIMING_DESK_LOST
+        if any(desk.mac_control24 is None or desk.last_heard < lost
+               for desk in self.desklinks):
+            filtstr = PCAP_FILTER % self.mac_computer_str
+        else:
+            # the desks' own broadcasts still pass, to see them restart
+            filtstr = PCAP_FILTER_DESKS % (self.mac_computer_str, ' or '.join(
+                'ether src %s' % hexl(desk.mac_control24).replace(' ', ':')
+                for desk in self.desklinks))
+        if filtstr == self.capture_filter:
+            return
+        try:
+            self.pcap_sess.setfilter(filtstr)
+        except OSError as err:
+            LOG.warn('Capture filter not changed: %s', err)
+            return
+        self.capture_filter = filtstr
+        LOG.info('Capture filter: %s', filtstr)
+
+    def forward_desk_data(self, desk, pkt_data):
+        """Pass data from the desk on to its clients"""
+        self.thread_listener.mpsend(desk, pkt_data)
+
+    # session instance methodsk0
+    def send_packet(self, buf):
+        """sesion wrapper around pcap_sendpacket
+        so we can pass in session and trap error"""
+        if TRACE:
+            LOG.debug("Sending Packet of %d bytes: %s", len(buf), LazyHex(buf))
+        pcap_status = self.pcap_sess.sendpacket(buf)
+        if pcap_status != len(buf):
+            LOG.warn("Error sending packet: %s", self.pcap_sess.geterr())
+            return False
+        return True
+
+    def log_stats(self):
+        """log the session statistics and the CPU used per desk
+        since the last time"""
+        cpu = sum(os.times()[:2])
+        cpu_delta = cpu - self.stats_cpu
+        self.stats_cpu = cpu
+        if self.capture_process is None:
+            busy = [desk.busy + desk.counts.busy for desk in self.desklinks]
+            label = 'cpu'
+        else:
+            # the capture process handles the packets, on its own cpu
+            busy = [desk.busy for desk in self.desklinks]
+            label = 'daemon cpu'
+        busy_delta = [now - before for now, before in zip(busy, self.stats_busy)]
+        self.stats_busy = busy
+        total_busy = sum(busy_delta)
+        LOG.info('Stats: %s:%.3fs %s', label, cpu_delta, self)
+        for desk, desk_busy in zip(self.desklinks, busy_delta):
+            if not desk.mac_control24 is None:
+                share = desk_busy / total_busy if total_busy else 0.0
+                LOG.info('Stats: %s %s:%.3fs', desk, label, cpu_delta * share)
+        for client in self.thread_listener.client_list():
+            client.inbound.reset_waits()
+
+    def __init__(self, opts, networks, local_conn=None):
+        """Constructor to build the session object.
+        Supply local_conn to serve an in-process client
+        instead of listening for one on the network"""
+        global LOG, TRACE
         LOG = start_logging('control24d', opts.logdir, opts.debug)
+        TRACE = tracing(LOG)
         # Create variables for a session
         self.network = networks.get(opts.network)
-        self.listen_address = networks.ipstr_to_tuple(opts.listen)
+        self.local_conn = local_conn
+        self.transport = opts.transport
+        if local_conn is None:
+            self.listen_address = networks.ipstr_to_tuple(opts.listen)
+        else:
+            self.listen_address = 'local'
         self.mp_listener = None
         self.mp_is_connected = False
-        self.mp_conn = None
         self.pcap_error_buffer = create_string_buffer(PCAP_ERRBUF_SIZE) # pcal error buffer
         self.fpcapt = pcap
         self.pcap_sess = None
         self.sniffer = None
+        self.capture_filter = None
         self.is_capturing = False
         self.is_closing = False
-        self.pcap_last_sent = tick()
-        self.pcap_last_packet = None
-        self.current_retry_desk = 0
-        #self.cmdcounter = c_uint32(0)
-        # desk-to-daw (cmdcounter) and daw-to-desk (sendcounter)
-        self.cmdcounter = 0
-        self.sendcounter = 1
-        self.sendlock = threading.Event()
-        self.sendlock.set()
-        self.backoff = threading.Timer(TIMING_BACKOFF, self._backoff)
         self.mac_computer_str = self.network.get('mac')
         self.mac_computer = MacAddress.from_buffer_copy(bytearray.fromhex(self.mac_computer_str.replace(':', '')))
-        self.mac_control24 = None
-        # build a re-usable Ethernet Header for sending packets
-        self.ethheader = EthHeader()
-        self.ethheader.macsrc = self.mac_computer
-        # Start the pcap loop background thread
-        self.thread_pcap_loop = Sniffer(self)
-        self.thread_pcap_loop.start()
+        self.ring = None
+        self.capture_process = None
+        # One link per desk that may be served, and a lookup
+        # by mac address for those that have been detected.
+        # Send locks are shared with any capture process
+        # which sets and clears them as the desks ACK
+        # So are their counts, which the capture process keeps
+        if opts.capture_process:
+            event = multiprocessing.Event
+            counts = lambda: multiprocessing.RawValue(DeskCounts)
+        else:
+            event = threading.Event
+            counts = DeskCounts
+        self.desklinks = [C24desklink(self, index, event(), counts())
+                          for index in range(opts.desks)]
+        self.desks = {}
+        self.stats_cpu = sum(os.times()[:2])
+        self.stats_busy = [0.0] * opts.desks
+        self.pcap_settings = pcap_settings(opts)
+        self.pcap_stats = PcapStats(opts.capture_process)
+        if opts.capture_process:
+            self.ring = ShmRing()
+            # Start the pcap loop in its own process, before any more
+            # threads exist here, and keep a handle to send with
+            self.capture_process = CaptureProcess(self, opts)
+            self.capture_process.start()
+            self.pcap_sess = self.fpcapt.pcap(
+                name=self.network.get('pcapname'),
+                promisc=False,
+                immediate=self.pcap_settings['immediate'],
+                timeout_ms=self.pcap_settings['timeout_ms']
+                )
+            self.pcap_sess.setfilter(PCAP_FILTER_NONE)
+            self.is_capturing = True
+            self.thread_ring_reader = RingReader(self)
+            self.thread_ring_reader.start()
+        else:
+            # Start the pcap loop background thread
+            self.thread_pcap_loop = Sniffer(self)
+            self.thread_pcap_loop.start()
+            self.thread_capture_monitor = CaptureMonitor(self)
+            self.thread_capture_monitor.start()
         # Start a thread to keep sending packets to desk to keep alive
         self.thread_keepalive = KeepAlive(self)
         self.thread_keepalive.start()
         # Start a thread to manager the MP listener
         self.thread_listener = ManageListener(self)
         self.thread_listener.start()
+        # Start a thread per desk to send the clients' commands on to it
+        self.thread_desk_senders = [DeskSender(self, desk) for desk in self.desklinks]
+        for thread in self.thread_desk_senders:
+            thread.start()
 
     def __str__(self):
         """pretty print session state if requested"""
-        return 'control24 session: is_capturing:{} mp_is_connected:{}'.format(
-            self.is_capturing, self.mp_is_connected)
+        return 'control24 session: is_capturing:{} {} mp_is_connected:{} {}'.format(
+            self.is_capturing, self.pcap_stats, self.mp_is_connected,
+            ' '.join(str(client) for client in self.thread_listener.client_list()))
 
     def close(self):
         """Quit the session gracefully if possible"""
@@ -572,8 +1326,9 @@ class C24session(object):
         # For threads under direct control this signals to please end
         self.is_closing = True
         # A bit of encouragement
-        if not self.mp_listener is None:
-            self.mp_listener.close()
+        self.thread_listener.close()
+        if not self.capture_process is None:
+            self.capture_process.terminate()
         # PCAP thread has its own KeyboardInterrupt handle
         LOG.info("C24session closed")
 
@@ -583,6 +1338,67 @@ class C24session(object):
         self.close()
 
 
+class C24capture(C24session):
+    """Cut down session for the capture process. It captures, ACKs and
+    tracks the send locks exactly as the full session, but passes
+    desk data and new desks back to the daemon through the ring"""
+    def __init__(self, process):
+        """Constructor to build the capture session, within the process"""
+        # pylint: disable=W0231
+        # Deliberately not calling the full session constructor
+        self.network = process.network
+        self.ring = process.ring
+        self.pcap_settings = process.pcap_settings
+        self.pcap_stats = process.pcap_stats
+        self.fpcapt = pcap
+        self.pcap_sess = None
+        self.capture_filter = None
+        self.is_capturing = False
+        self.is_closing = False
+        self.mac_computer_str = process.mac_computer_str
+        self.mac_computer = MacAddress.from_buffer_copy(bytearray.fromhex(self.mac_computer_str.replace(':', '')))
+        self.desklinks = [C24desklink(self, index, sendlock, counts)
+                          for index, (sendlock, counts)
+                          in enumerate(zip(process.sendlocks, process.counts))]
+        self.desks = {}
+        self.thread_pcap_loop = Sniffer(self)
+
+    def __str__(self):
+        """pretty print session state if requested"""
+        return 'control24 capture: is_capturing:{} {} ring dropped:{} {}'.format(
+            self.is_capturing, self.pcap_stats, self.ring.dropped.value,
+            ' '.join(str(desk) for desk in self.desklinks))
+
+    def desk_detected(self, macsrc, device, version, desk=None):
+        """Note the desk address for ACKs, and leave the
+        daemon to bring it online"""
+        if desk is None:
+            desk = self.free_desk() or self.lost_desk()
+        if desk is None:
+            return
+        LOG.info('Desk %d detected: %s %s at %s', desk.index, device, version, hexl(macsrc))
+        self.take_desk(desk, macsrc, device)
+        data = (c_char * 24)()
+        data[0:6] = string_at(addressof(macsrc), 6)
+        data[6:6 + len(version)] = version
+        data[15:15 + len(device)] = device
+        self.ring.put(RING_DISCOVERY, desk.index, data, 24)
+        self.update_filter()
+
+    def forward_desk_data(self, desk, pkt_data):
+        """Pass data from the desk over to the daemon"""
+        if not self.ring.put(RING_DESKDATA, desk.index, pkt_data, len(pkt_data)):
+            LOG.warn('Capture ring full, desk data dropped. Total dropped: %d',
+                     self.ring.dropped.value)
+
+    def close(self):
+        """Nothing to close except the capture, which ends with the process"""
+        self.is_closing = True
+
+    def __del__(self):
+        pass
+
+
 # END classes
 
 # START main program
@@ -611,8 +1427,22 @@ def main():
         "--listen",
         dest="listen",
         help="listen on given host:port. Default = %s" % default_listener)
+    opts_transport(oprs)
+    oprs.add_option(
+        "--capture-process",
+        dest="capture_process",
+        action="store_true",
+        help="capture and ACK desk packets in a separate process. default = off")
     oprs.set_defaults(network=default_iface)
     oprs.set_defaults(listen=default_listener)
+    oprs.add_option(
+        "--desks",
+        dest="desks",
+        type="int",
+        help="serve up to this many desks on the network. default = 1")
+    opts_pcap(oprs)
+    oprs.set_defaults(capture_process=False)
+    oprs.set_defaults(desks=1)
 
     # Parse and verify options
     # TODO move to argparse and use that to verify
@@ -625,7 +1455,8 @@ def main():
             )
     if not networks.verify_ip(opts.listen.split(':')[0]):
         raise OptionError('No network has the IP address specified.', 'listen')
-
+    if opts.desks < 1 or opts.desks > 255:
+        raise OptionError('Number of desks must be from 1 to 255.', 'desks')
 
     # Build the C24Session
     if SESSION is None:
@@ -6,19 +6,34 @@ protocols such as MIDI HUI, Mackie etc.
 """
 
 import binascii
+import collections
+import errno
+import json
+import os
+import Queue
 import signal
+import socket
+import SocketServer
 import sys
 import threading
 import time
 from ctypes import c_ubyte
-from multiprocessing.connection import Client
+from multiprocessing.connection import AuthenticationError, Client
 from optparse import OptionError
 
 import OSC
 
-from control24common import (DEFAULTS, FADER_RANGE, NetworkHelper,
-                             opts_common, start_logging, tick)
+from control24common import (DEFAULTS, MP_CONTROL, MP_ONLINE, ClassQueue,
+                             LazyHex, NetworkHelper, classify, command_key,
+                             get_scheduler, link_client, mp_batches,
+                             mp_select_desk, opts_common, opts_transport,
+                             start_logging, tick, tracing)
 from control24map import MAPPING_TREE
+from control24codec import (FADER_FRAME, METER_BYTES, fader_frame,
+                            fader_frames, fader_gain, fader_position,
+                            fader_position_from_bytes, meter_bytes, pan_ring)
+from control24state import (FADER_UNSET, MODE_CLOCK, MODE_DESK, MODE_NAV,
+                             SPEAKERS, UNSET, C24store)
 
 '''
     This file is part of ReaControl24. Control Surface Middleware.
@@ -41,22 +56,90 @@ from control24map import MAPPING_TREE
 # Timing values in seconds
 TIMING_MAIN_LOOP = 10  # 0
 TIMING_SERVER_POLL = 2
+TIMING_SERVER_RETRY = 0.01
 TIMING_MP_POLL = 1
+MP_QUEUE_SIZE = 256     # Commands held for the daemon in each class
 TIMING_WAIT_OSC_LISTENER = 4
 TIMING_OSC_LISTENER_RESTART = 1
 TIMING_OSC_CLIENT_RESTART = 1
 TIMING_OSC_CLIENT_LOOP = 4
 TIMING_SCRIBBLESTRIP_RESTORE = 1
+TIMING_SCRIBBLESTRIP_REFRESH = 0.02
+TIMING_RESYNC = 0.05    # Gathers resync requests arriving close together
+CLOCK_RATE = 20         # Clock display updates per second at most
+CLOCK_CACHE_SIZE = 64
+STATE_FILE = 'control24osc.{}.state'   # in the log directory, per desk
 TIMING_FADER_ECHO = 0.1
+TIMING_FADER_ECHO_WINDOW = 0.3  # How long the DAW may take to echo a fader move
+FADER_ECHO_TOLERANCE = 4        # 10 bit steps an echo may be out by
+FADER_ECHO_SENT = 16            # Recent moves remembered per fader
+TIMING_MOTOR_TICK = 0.01        # Fader motor moves are sent on these ticks
+MOTOR_GROUPS = 4                # Faders take turns, one group per tick
+TIMING_CONTROL_WINDOW = 0.02    # Fader and pot moves to the DAW are merged over this
+TIMING_JOG_WINDOW = 0.04        # Jog wheel ticks are added up over this
+JOG_VELOCITY_SLOW = 8           # Jog velocity up to which a tick counts once
+JOG_VELOCITY_REF = 16           # Velocity above slow at which a tick counts double
+JOG_ACCEL_MAX = 8               # Most a tick can count for when spun fast
+TIMING_STATS = 60       # How often session statistics are logged
+TIMING_QUERY_WATCH = 0.05   # How often a watching reader is sent changes
+
+# Connection refused errno on linux, macos and windows
+CONNECTION_REFUSED = (errno.ECONNREFUSED, 61, 10061)
+# Errors connecting to a daemon on another host that may clear up
+CONNECTION_TRANSIENT = (errno.ECONNRESET, errno.ETIMEDOUT,
+                        errno.EHOSTUNREACH, errno.ENETUNREACH)
 
 SESSION = None
 # Globals
 LOG = None
+TRACE = False       # debug lines on the command paths, set with LOG
 
 # Control24 functions
 # Split command list on repeats of the same starting byte or any instance of the F7 byte
 
 # Housekeeping functions
+def opts_clock(oprs):
+    """Add the clock display rate option, shared with control24"""
+    oprs.add_option(
+        "--clock-rate",
+        dest="clock_rate",
+        type="float",
+        help="most clock display updates per second. default %d" % CLOCK_RATE)
+    oprs.set_defaults(clock_rate=CLOCK_RATE)
+
+
+def opts_state(oprs):
+    """Add the desk state file option, shared with control24"""
+    oprs.add_option(
+        "--state-file",
+        dest="state_file",
+        help="keep the desk state in this file to restore it on restart, "
+        "- for none. default %s in the log directory" % STATE_FILE.format('<desk>'))
+    oprs.set_defaults(state_file=None)
+
+
+def opts_query(oprs):
+    """Add the state query socket option, shared with control24"""
+    oprs.add_option(
+        "--query",
+        dest="query",
+        help="serve the desk state to local readers at host:port, "
+        "- for none. default 127.0.0.1:%d plus the --desk number, "
+        "so each desk's client has its own" % DEFAULTS.get('query'))
+    oprs.set_defaults(query=None)
+
+
+def opts_controls(oprs):
+    """Add the control limiter option, shared with control24"""
+    oprs.add_option(
+        "--control-window",
+        dest="control_window",
+        type="float",
+        help="seconds over which fader and pot moves to the DAW are merged. "
+        "default %s" % TIMING_CONTROL_WINDOW)
+    oprs.set_defaults(control_window=TIMING_CONTROL_WINDOW)
+
+
 def signal_handler(sig, stackframe):
     """Exit the daemon if a signal is received"""
     signals_dict = dict((getattr(signal, n), n)
@@ -146,6 +229,7 @@ class ModeManager(object):
 # Classes representing Control24
 class C24base(object):
     """base class to make available standard functions"""
+    __slots__ = ()
     @staticmethod
     def initbytes(bytelist):
         """load the command byte array with
@@ -157,23 +241,37 @@ class C24base(object):
         return retbytes
 
     @staticmethod
-    def parsedcmd_simplebutton(parsedcmd):
-        """from a parsedcmd, extract the last address and value"""
-        #TODO investigate if a parsed command class is the way to go instead
-        return parsedcmd.get('addresses')[-1], parsedcmd.get('Value')
+    def frame(bytelist):
+        """return an immutable desk frame ready to send,
+        so sending is a table lookup rather than a rebuild"""
+        return str(bytearray(bytelist))
 
     @staticmethod
-    def tenbits(num):
-        """Return 7 bits in one byte and 3 in the next for an integer provided"""
-        num = num & 0x3FF
-        return (num >> 3, (num & 7) << 4)
+    def led_frames(mapping_osc):
+        """Precompute the (off, on) frames for every button LED,
+        by address then by track number, None for no track"""
+        frames = {}
+        for addr, lkpbtn in mapping_osc.iteritems():
+            tbyt = lkpbtn.get('TrackByte')
+            tracks = [None]
+            if not tbyt is None:
+                tracks.extend(range(32))
+            pairs = {}
+            for track_number in tracks:
+                byts = list(lkpbtn['cmdbytes'])
+                if not track_number is None:
+                    byts[tbyt] |= track_number
+                off = C24base.frame(byts)
+                byts[2] |= 0x40
+                pairs[track_number] = (off, C24base.frame(byts))
+            frames[addr] = (lkpbtn.get('Toggle'), pairs)
+        return frames
 
     @staticmethod
-    def calc_faderscale():
-        """Return a dict that converts tenbit 7 bit pair into gain factor 0-1"""
-        fader_range = 2**10
-        fader_step = 1 / float(fader_range)
-        return {C24base.tenbits(num): num * fader_step for num in range(0, fader_range)}
+    def parsedcmd_simplebutton(parsedcmd):
+        """from a parsedcmd, extract the last address and value"""
+        #TODO investigate if a parsed command class is the way to go instead
+        return parsedcmd.get('addresses')[-1], parsedcmd.get('Value')
 
     @staticmethod
     def walk(node, path, byts, cbyt, tbyt, outp):
@@ -244,6 +342,7 @@ class C24nav(C24base):
         if self.modemgr.is_valid_mode(button):
             if val == 1:
                 self.modemgr.set_mode(button)
+                self.desk.store.set_mode(MODE_NAV, button)
                 self.update()
         else: #remainder is the cursors mapped to class
             addr = self.modemgr.get('osc_address') + button
@@ -299,7 +398,7 @@ class C24desk(C24base):
         }
     }
 
-    def __init__(self, osc_client_send, c24_client_send):
+    def __init__(self, osc_client_send, c24_client_send, c24_client_batch):
         # DONE original mode management to be deprecated
         # phunkyg 29/09/2-18
         # self.mode = DEFAULTS.get('scribble')
@@ -307,10 +406,23 @@ class C24desk(C24base):
         # passthrough methods
         self.osc_client_send = osc_client_send
         self.c24_client_send = c24_client_send
+        self.c24_client_batch = c24_client_batch
+        # State of every control, which the track objects are views over
+        self.store = C24store(
+            C24buttonled.frames_osc.keys(),
+            ['/track/number'] + sorted(
+                mode['address'] for mode in self.deskmodes.values()
+                if mode.has_key('address')))
+        # Scribble strips show their text through this
+        self.c24scribcompositor = C24scribcompositor(self)
+        self.resync_call = None
+        self.started = tick()
+        self.ready = False
         # Set up the child track objects
         self.c24tracks = [C24track(self, track_number)
                           for track_number in range(0, 32)]
         self.c24clock = C24clock(self)
+        self.c24motors = C24motors(self)
         self.c24buttonled = C24buttonled(self, None)
         self.c24nav = C24nav(self)
         self.c24modifiers = C24modifiers(self)
@@ -319,11 +431,87 @@ class C24desk(C24base):
         """set the global desk mode"""
         LOG.debug('Desk mode set: %s', mode)
         self.modemgr.set_mode(mode)
+        self.store.set_mode(MODE_DESK, mode)
         for track in self.c24tracks:
             track.modemgr.set_mode(mode)
             if hasattr(track, 'c24scribstrip'):
                 track.c24scribstrip.restore_desk_display()
 
+    def restore_state(self, path):
+        """Keep the store in a state file, picking up the state and
+        modes left there by the last run if there are any"""
+        if not self.store.map_file(path):
+            LOG.info('Desk state file %s started', path)
+            return False
+        mode = self.store.mode(MODE_DESK)
+        if self.modemgr.is_valid_mode(mode):
+            self.set_mode(mode)
+        mode = self.store.mode(MODE_CLOCK)
+        if self.c24clock.modemgr.is_valid_mode(mode):
+            self.c24clock.modemgr.set_mode(mode)
+            self.c24clock._set_things()
+        mode = self.store.mode(MODE_NAV)
+        if self.c24nav.modemgr.is_valid_mode(mode):
+            self.c24nav.modemgr.set_mode(mode)
+        LOG.info('Desk state restored from %s in %.1fms', path,
+                 (tick() - self.started) * 1000)
+        return True
+
+    def limiters(self):
+        """the limiters of every fader and pot"""
+        return [control.limiter for track in self.c24tracks
+                for control in (getattr(track, 'c24fader', None),
+                                getattr(track, 'c24vpot', None))
+                if isinstance(control, (C24fader, C24vpot))]
+
+    def set_control_window(self, window):
+        """Merge fader and pot moves to the DAW over this many seconds"""
+        for limiter in self.limiters():
+            limiter.window = window
+
+    def request_resync(self):
+        """Bring the desk up to date shortly, so that several
+        requests close together make one resync"""
+        if self.resync_call is None:
+            self.resync_call = get_scheduler(LOG).call_later(TIMING_RESYNC, self.resync)
+        else:
+            self.resync_call.reschedule(TIMING_RESYNC)
+
+    def resync(self):
+        """Send the desk everything it should be showing, from the
+        store, in as few packets as it will take. Faders are sent once
+        the DAW, the desk or a restored state has set them, so a fresh
+        start leaves them where they are. LEDs and pot rings are sent
+        only if they are lit"""
+        cmds = []
+        state = self.store.state
+        self.c24motors.forget()
+        positions = state.fader[:self.channels]
+        faders = fader_frames([0 if position == FADER_UNSET else position
+                               for position in positions])
+        cmds.extend(faders[track_number * FADER_FRAME.size:
+                           (track_number + 1) * FADER_FRAME.size]
+                    for track_number, position in enumerate(positions)
+                    if position != FADER_UNSET)
+        for track in self.c24tracks:
+            track_number = track.track_number
+            if isinstance(getattr(track, 'c24vpot', None), C24vpot):
+                pang = state.vpot[track_number]
+                if pang != UNSET:
+                    cmds.append(track.c24vpot.frames[pang])
+            if hasattr(track, 'c24automode'):
+                bits = state.automode[track_number]
+                if bits:
+                    cmds.append(track.c24automode.frames[bits])
+        for addr, track_number in self.store.leds_on():
+            cmds.append(C24buttonled.frames_osc[addr][1][track_number][1])
+        cmds.extend(self.c24scribcompositor.resync_frames())
+        LOG.info('Desk resync of %d commands', len(cmds))
+        if self.c24_client_batch(cmds) and not self.ready:
+            self.ready = True
+            LOG.info('Desk ready %.3fs after start', tick() - self.started)
+        self.c24clock.resync()
+
     def get_track(self, track):
         """Safely access both the main tracks and any virtual
         ones in the address space between 24 and 31"""
@@ -345,9 +533,127 @@ class C24desk(C24base):
                 track.c24scribstrip.c_d(['c24scribstrip', 'long'], [piece])
 
 
+class C24limiter(object):
+    """Limit the messages from one control to the DAW. The first move
+    after a quiet spell is sent at once, moves within the window after
+    a send are merged, and the last one is always sent when the window
+    ends. send is called to send whatever the control's value is then"""
+    __slots__ = ('send', 'window', 'last_sent', 'pending', 'trailing',
+                 'lock', 'passed', 'merged')
+
+    def __init__(self, send, window=TIMING_CONTROL_WINDOW):
+        self.send = send
+        self.window = window
+        self.last_sent = 0.0
+        self.pending = False
+        self.trailing = None
+        self.lock = threading.Lock()
+        self.passed = 0
+        self.merged = 0
+
+    def __str__(self):
+        return 'passed:{} merged:{}'.format(self.passed, self.merged)
+
+    def offer(self):
+        """the control has moved"""
+        with self.lock:
+            wait = self.last_sent + self.window - tick()
+            if wait > 0 or self.pending:
+                if not self.pending:
+                    self.pending = True
+                    if self.trailing is None:
+                        self.trailing = get_scheduler(LOG).call_later(wait, self._trail)
+                    else:
+                        self.trailing.reschedule(wait)
+                else:
+                    self.merged += 1
+                return
+            self.last_sent = tick()
+            self.passed += 1
+        self.send()
+
+    def cancel(self):
+        """forget any move waiting to be sent"""
+        with self.lock:
+            self.pending = False
+            if not self.trailing is None:
+                self.trailing.cancel()
+
+    def _trail(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.pending = False
+            self.last_sent = tick()
+            self.passed += 1
+        self.send()
+
+
+class C24motors(object):
+    """Move the fader motors at a rate they can follow. The DAW's
+    positions only go in the store, and each tick moves the faders of
+    one group that have changed by at least a step since they were
+    last moved. A stream of automation for every track is spread
+    evenly over the ticks, and only the latest position is sent"""
+
+    def __init__(self, desk):
+        self.desk = desk
+        self.dirty = set()
+        self.sent = {}
+        self.group = 0
+        self.lock = threading.Lock()
+        self.tick_call = None
+
+    def __str__(self):
+        return 'C24motors waiting:{}'.format(len(self.dirty))
+
+    def move(self, fader):
+        """move the fader to its stored position on its next turn"""
+        with self.lock:
+            self.dirty.add(fader)
+            if self.tick_call is None:
+                self.tick_call = get_scheduler(LOG).call_later(TIMING_MOTOR_TICK, self.tick)
+            elif not self.tick_call.active():
+                self.tick_call.reschedule(TIMING_MOTOR_TICK)
+
+    def moved(self, fader):
+        """the fader has moved other than by a tick, by hand or
+        by a frame sent straight to it, so note where it is now"""
+        with self.lock:
+            self.sent[fader] = fader.position
+
+    def forget(self):
+        """the desk has been sent every fader, so
+        don't skip any next time"""
+        with self.lock:
+            self.sent.clear()
+
+    def tick(self):
+        """send the moves for this tick's group"""
+        with self.lock:
+            due = [fader for fader in self.dirty
+                   if fader.track.track_number % MOTOR_GROUPS == self.group]
+            self.group = (self.group + 1) % MOTOR_GROUPS
+            self.dirty.difference_update(due)
+            if self.dirty:
+                self.tick_call.reschedule(TIMING_MOTOR_TICK)
+            moves = []
+            for fader in due:
+                position = fader.position
+                if fader.touch_status or self.sent.get(fader) == position:
+                    continue
+                self.sent[fader] = position
+                moves.append(fader.frame())
+        for frame in moves:
+            self.desk.c24_client_send(frame)
+
+
 class C24track(C24base):
     """Track (channel strip) object to contain
     one each of the bits found in each of the 24 main tracks"""
+    __slots__ = ('desk', 'track_number', 'modemgr', 'osctrack_number',
+                 'c24fader', 'c24vpot', 'c24vumeter', 'c24buttonled',
+                 'c24automode', 'c24scribstrip')
 
     def __init__(self, desk, track_number):
         self.desk = desk
@@ -496,6 +802,13 @@ class C24clock(C24base):
         self.modemgr = ModeManager(self.clockmodes)
         self.cmdbytes = self.initbytes(self.clockbytes)
         self.ledbytes = self.initbytes(self.ledbytes)
+        # encodings of recent texts, and what the desk was last sent
+        self.cache = {}
+        self.shown = None
+        self.lock = threading.Lock()
+        self.interval = 1.0 / CLOCK_RATE
+        self.last_sent = 0
+        self.pending = None
         self._set_things()
 
     def __str__(self):
@@ -508,21 +821,55 @@ class C24clock(C24base):
         self.cmdbytes[5] = self.modemgr.get('dots')
         self.ledbytes[5] = self.modemgr.get('LED')
         self.formatter = getattr(self, self.modemgr.get('formatter'))
+        # Encodings depend on the formatter, and the dots have changed
+        self.cache = {}
+        self.shown = None
 
-    def _update(self):
-        # Apply whichever formatter function is indicated
+    def resync(self):
+        """Send the display again, whatever the desk was last sent"""
+        with self.lock:
+            self.shown = None
+            self.last_sent = 0
+        self._update()
+
+    def set_rate(self, rate):
+        """Limit the display to this many updates per second"""
+        self.interval = 1.0 / rate
 
-        optext = self.formatter(self.text[self.modemgr.mode])
-        # For now, display whatever mode we last gotfrom the daw
-        self.op_list = self._xform_txt(optext)
-        self.byt_list = list(self.op_list)
-        self.cmdbytes[6:14] = [byt for byt in self.byt_list]
-        self.desk.c24_client_send(self.cmdbytes)
+    def _update(self):
+        """Send the current mode's text if the display would change.
+        Updates faster than the rate are held for a last one on time"""
+        with self.lock:
+            wait = self.last_sent + self.interval - tick()
+            if wait > 0:
+                if self.pending is None:
+                    self.pending = get_scheduler(LOG).call_later(wait, self._update)
+                elif not self.pending.active():
+                    self.pending.reschedule(wait)
+                return
+            text = self.text.get(self.modemgr.mode)
+            if text is None:
+                return
+            self.byt_list = self.cache.get(text)
+            if self.byt_list is None:
+                # Apply whichever formatter function is indicated
+                optext = self.formatter(text)
+                self.byt_list = tuple(self._xform_txt(optext))
+                if len(self.cache) >= CLOCK_CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[text] = self.byt_list
+            if self.byt_list == self.shown:
+                return
+            self.shown = self.byt_list
+            self.last_sent = tick()
+            self.cmdbytes[6:14] = self.byt_list
+            self.desk.c24_client_send(self.cmdbytes)
 
     def d_c(self, parsedcmd):
         """Toggle the mode"""
         if parsedcmd.get('Value') == 1.0:
             self.modemgr.toggle_mode()
+            self.desk.store.set_mode(MODE_CLOCK, self.modemgr.mode)
             self._set_things()
             self.desk.c24_client_send(self.ledbytes)
             self._update()
@@ -532,13 +879,14 @@ class C24clock(C24base):
         mode = addrlist[2]
         self.text[mode] = stuff[0]
         # for speed we simply ignore any osc message that isn't
-        # for the current mode.
+        # for the current mode, beyond keeping the text for a toggle
         if mode == self.modemgr.mode:
             self._update()
 
 
 class C24vumeter(C24base):
     """Class to hold and convert VU meter value representations"""
+    __slots__ = ('track', 'frames')
 
     # 0xf0, 0x13, 0x01 = display
     # 0x10 - VUs
@@ -549,61 +897,98 @@ class C24vumeter(C24base):
     # 0x00 MSB
     # 0x00 LSB
     # 0xf7 terminator
-    meterscale = [
-        (0, 0),
-        (0, 1),
-        (0, 3),
-        (0, 7),
-        (0, 15),
-        (0, 31),
-        (0, 63),
-        (0, 127),
-        (1, 127),
-        (3, 127),
-        (7, 127),
-        (15, 127),
-        (31, 127),
-        (63, 127),
-        (127, 127)
-    ]
+    meterscale = METER_BYTES
 
     def __init__(self, track):
         self.track = track
-        self.vu_val = {'postfader': [(0, 0), (0, 0)], 'prefader': [
-            (0, 0), (0, 0)]}
-        self.mode = 'postfader'
-        self.cmdbytes = (c_ubyte * 8)()
-
-        for ind, byt in enumerate([0xf0, 0x13, 0x01, 0x10, track.track_number, 0x7f, 0x7f, 0xf7]):
-            self.cmdbytes[ind] = byt
+        # Ready made frames for each speaker and meter level
+        self.frames = {}
+        for spkr in range(SPEAKERS):
+            for level in self.meterscale:
+                self.frames[(spkr, level)] = self.frame(
+                    [0xf0, 0x13, 0x01, 0x10, 32 * spkr + track.track_number,
+                     level[0], level[1], 0xf7])
 
     def __str__(self):
-        return 'vu_val:{}, mode: {}, CmdBytes:{}'.format(
-            self.vu_val,
-            self.mode,
-            binascii.hexlify(self.cmdbytes)
+        store = self.track.desk.store
+        return 'Meters:{}'.format(
+            [store.meter(self.track.track_number, spkr) for spkr in range(SPEAKERS)]
         )
 
     def c_d(self, addrlist, stuff):
         """Update from DAW value"""
         spkr = int(addrlist[3])
         val = stuff[0]
-        mode = 'postfader'
-
-        self.mode = mode
-        this_val = self.vu_val.get(mode)
-        if not this_val is None:
-            new_val = self._xform_vu(val)  # take a copy before change
-            if new_val != this_val[spkr]:
-                this_val[spkr] = new_val
-                # For now, display whatever mode we last gotfrom the daw
-                self.cmdbytes[4] = 32 * spkr + self.track.track_number
-                self.cmdbytes[5], self.cmdbytes[6] = this_val[0]
-                self.track.desk.c24_client_send(self.cmdbytes)
+        store = self.track.desk.store
+        track_number = self.track.track_number
+        new_val = meter_bytes(val)
+        if new_val != store.meter(track_number, spkr):
+            store.set_meter(track_number, spkr, new_val)
+            # For now, display whatever mode we last gotfrom the daw
+            self.track.desk.c24_client_send(
+                self.frames[(spkr, store.meter(track_number, 0))])
 
-    @staticmethod
-    def _xform_vu(val):
-        return C24vumeter.meterscale[int(val * 15)]
+
+class C24scribcompositor(object):
+    """Class to gather scribble strip updates and send the strips that
+    changed together, on a refresh tick, so a mode change or a
+    project load goes to the desk in a packet or two"""
+
+    def __init__(self, desk):
+        self.desk = desk
+        self.shown = {}
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.refresh = None
+
+    def show(self, scribstrip):
+        """Take the strip's current text, to be sent on the next tick
+        unless it is what the desk already shows"""
+        track_number = scribstrip.track.track_number
+        with self.lock:
+            if self.shown.get(track_number) == scribstrip.dtext4ch:
+                self.dirty.pop(track_number, None)
+                return
+            self.dirty[track_number] = scribstrip
+            if self.refresh is None:
+                self.refresh = get_scheduler(LOG).call_later(
+                    TIMING_SCRIBBLESTRIP_REFRESH, self.flush)
+            elif not self.refresh.active():
+                self.refresh.reschedule(TIMING_SCRIBBLESTRIP_REFRESH)
+
+    def invalidate(self):
+        """Forget what the desk shows, so every strip is sent again"""
+        with self.lock:
+            self.shown = {}
+
+    def resync_frames(self):
+        """Return frames for every strip, taking them as shown"""
+        with self.lock:
+            self.dirty = {}
+            self.shown = {}
+            cmds = []
+            for track in self.desk.c24tracks:
+                if hasattr(track, 'c24scribstrip'):
+                    self.shown[track.track_number] = track.c24scribstrip.dtext4ch
+                    cmds.append(track.c24scribstrip.frame())
+        return cmds
+
+    def flush(self):
+        """Send the changed strips in track order"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            texts = {}
+            cmds = []
+            for track_number in sorted(dirty):
+                scribstrip = dirty[track_number]
+                texts[track_number] = scribstrip.dtext4ch
+                cmds.append(scribstrip.frame())
+        if cmds:
+            LOG.debug('c24scribcompositor sending %d strips', len(cmds))
+            # Only count them as shown if they got to the daemon
+            if self.desk.c24_client_batch(cmds):
+                with self.lock:
+                    self.shown.update(texts)
 
 
 class C24scribstrip(C24base):
@@ -614,38 +999,45 @@ class C24scribstrip(C24base):
     # 0x00      = ?
     # 0x00, 0x00, 0x00, 0x00 = 4 'ascii' chars to display
     # 0xf7             = terminator
+    __slots__ = ('track', 'mode', 'prefix', 'last_update', 'restore_timer')
 
     def __init__(self, track):
         self.track = track
         self.mode = track.modemgr.get_data()
+        self.prefix = C24base.frame([0xf0, 0x13, 0x01, 0x40, self.track.track_number, 0x00])
         defaulttext = '  {num:02d}'.format(num=self.track.track_number + 1)
         self.dtext4ch = defaulttext
-        self.text = {'/track/number': defaulttext}
-        self.cmdbytes = (c_ubyte * 12)()
+        self.track.desk.store.set_text(self.track.track_number, '/track/number', defaulttext)
         self.last_update = time.time()
 
-        self.restore_timer = threading.Timer(
-            float(TIMING_SCRIBBLESTRIP_RESTORE), self.restore_desk_display)
-
-        for ind, byt in enumerate(
-                [0xf0, 0x13, 0x01, 0x40, self.track.track_number,
-                 0x00, 0x00, 0x00, 0x00, 0x00, 0xf7]):
-            self.cmdbytes[ind] = byt
+        self.restore_timer = None
 
     def __str__(self):
         return 'Channel:{}, Text:{}, CmdBytes:{}'.format(
-            self.track,
-            self.text,
-            binascii.hexlify(self.cmdbytes)
+            self.track.track_number,
+            self.track.desk.store.text(self.track.track_number, self.mode),
+            binascii.hexlify(self.frame())
         )
 
+    @property
+    def dtext4ch(self):
+        """the 4 characters for the strip, kept in the desk store"""
+        return self.track.desk.store.state.scribble[self.track.track_number].value
+
+    @dtext4ch.setter
+    def dtext4ch(self, text4ch):
+        self.track.desk.store.set_scribble(self.track.track_number, text4ch)
+
+    def frame(self):
+        """the command bytes to show the current 4 characters"""
+        return ''.join([self.prefix, self.dtext4ch, '\xf7\x00'])
+
     def set_current_display(self):
         """send the current display state to the desk"""
         self.transform_text()
-        self.cmdbytes[6:10] = [ord(thischar) for thischar in self.dtext4ch]
         LOG.debug('c24scribstrip mode state: %s = %s',
                   self.mode, self.dtext4ch)
-        self.track.desk.c24_client_send(self.cmdbytes)
+        self.track.desk.c24scribcompositor.show(self)
 
     def restore_desk_display(self):
         """ To be called in a delayed fashion
@@ -657,7 +1049,7 @@ class C24scribstrip(C24base):
     def transform_text(self):
         """transform the basic text string into one that
         is ready for the 4 character scribble strip"""
-        dtext = self.text.get(self.mode)
+        dtext = self.track.desk.store.text(self.track.track_number, self.mode)
         if not dtext is None:
             # The desk has neat characters with a dot and small numeral,
             # Which is nice because 1 char is saved
@@ -676,26 +1068,36 @@ class C24scribstrip(C24base):
         """Update from DAW text"""
         address = '/'.join(addrlist)
         textvalue = stuff[0]
-        self.text[address] = textvalue
+        if not self.track.desk.store.set_text(self.track.track_number, address, textvalue):
+            LOG.warn('c24scribstrip no room to keep text for %s', address)
         if address == self.mode:
             self.set_current_display()
         else:
             if time.time() - self.last_update > TIMING_SCRIBBLESTRIP_RESTORE:
                 self.mode = address
                 self.set_current_display()
-                if self.restore_timer.isAlive:
-                    self.restore_timer.cancel()
-                self.restore_timer = threading.Timer(
-                    float(TIMING_SCRIBBLESTRIP_RESTORE), self.restore_desk_display)
-                self.restore_timer.start()
+                if self.restore_timer is None:
+                    self.restore_timer = get_scheduler(LOG).call_later(
+                        float(TIMING_SCRIBBLESTRIP_RESTORE), self.restore_desk_display)
+                else:
+                    self.restore_timer.reschedule(float(TIMING_SCRIBBLESTRIP_RESTORE))
 
 
 
 class C24jpot(C24base):
-    """Class for the Control24 Jog wheel"""
+    """Class for the Control24 Jog wheel. In shuttle mode ticks are
+    added up over a short window, each counting for more the faster
+    the wheel is spun, and sent to the DAW as one rotary move per
+    window. Scrub sends the direction of each tick, 1 or 0"""
     #'DirectionByte': 2,1
     #'DirectionByteMask': 0x40,
     #'ValueByte': 3
+    # How far from the rotary centre one shuttle tick moves
+    unit = 0.05
+    # How much a tick counts for at each velocity
+    accel = [min(1 + (float(max(vel - JOG_VELOCITY_SLOW, 0)) / JOG_VELOCITY_REF) ** 2,
+                 JOG_ACCEL_MAX)
+             for vel in range(128)]
 
     def __init__(self, track):
         self.track = track
@@ -704,7 +1106,10 @@ class C24jpot(C24base):
         self.dir = 0
         self.velocity = 0
         self.out = 0
-        self.scrubout = 0
+        self.delta = 0.0
+        self.window = None
+        self.window_open = False
+        self.lock = threading.Lock()
         # Make the class modeful
         #TODO use the mode manager class
         self.mode = None
@@ -753,30 +1158,63 @@ class C24jpot(C24base):
             self.val = self.cmdbytes[2]
             if self.val > 64:
                 self.dir = 1
-                self.scrubout = 1
             else:
                 self.dir = -1
-                self.scrubout = 0
 
             self.velocity = self.cmdbytes[3]
-            self.out = 0.5 + (float(self.val - 64) * float(0.05))
-            #self.out += float(self.val - 64) * 0.00001
-
-            currmode = self.modes.get(self.mode)
-            msg = currmode.get('msg')
-            msg.clearData()
-
             if self.mode == 'Scrub':
-                msg.append(self.scrubout)
+                self.out = 1 if self.dir == 1 else 0
+                self._send_out(self.out)
+                return
+            with self.lock:
+                self.delta += (self.val - 64) * self.accel[self.velocity & 0x7F]
+                if self.window_open:
+                    return
+                # Send the first tick at once, and open a window for the rest
+                self.window_open = True
+                if self.window is None:
+                    self.window = get_scheduler(LOG).call_later(
+                        TIMING_JOG_WINDOW, self._window_end)
+                else:
+                    self.window.reschedule(TIMING_JOG_WINDOW)
+            self._send()
+
+    def _window_end(self):
+        """send what was added up in the window, and keep the window
+        open while the wheel is still turning"""
+        with self.lock:
+            if self.delta:
+                self.window.reschedule(TIMING_JOG_WINDOW)
             else:
-                msg.append(self.out)
-
+                self.window_open = False
+                return
+        self._send()
+
+    def _send(self):
+        """send the ticks added up so far as one rotary move"""
+        with self.lock:
+            delta, self.delta = self.delta, 0.0
+        if not delta:
+            return
+        # the DAW takes a rotary value from 0 to 1, centre 0.5
+        self.out = min(max(0.5 + delta * self.unit, 0.0), 1.0)
+        self._send_out(self.out, 'Shuttle')
+
+    def _send_out(self, value, mode=None):
+        """send a value to the address of the mode, the current one
+        by default. A message each, as the window sends from the
+        scheduler thread"""
+        msg = OSC.OSCMessage(self.modes.get(mode or self.mode).get('address'))
+        msg.append(value)
+        if TRACE:
             LOG.debug('%s', self)
-            self.track.desk.osc_client_send(msg)
+        self.track.desk.osc_client_send(msg)
 
 
 class C24vpot(C24base):
     """Class for the Control24 Virtual Pots"""
+    __slots__ = ('track', 'frames', 'osc_address', 'osc_message',
+                 'limiter')
     #'DirectionByte': 2,
     #'DirectionByteMask': 0x40,
     #'ValueByte': 3
@@ -819,67 +1257,56 @@ class C24vpot(C24base):
 
     def __init__(self, track):
         self.track = track
-        self.pang = 0
-        self.panv = 0,
-        self.pan = float(0.5)
-        self.cmdbytes_d_c = (c_ubyte * 30)()
-        self.cmdbytes = (c_ubyte * 8)()
-        for ind, byt in enumerate(
-                [0xF0, 0x13, 0x01, 0x00, self.track.track_number & 0x3f,
-                 0x00, 0x00, 0xF7]):
-            self.cmdbytes[ind] = byt
-            self.cmdbytes_d_c[ind] = byt
+        # Ready made frames for each step of the LED ring
+        self.frames = []
+        for led in self.scale_fill:
+            self.frames.append(self.frame(
+                [0xF0, 0x13, 0x01, 0x00,
+                 led[0] | (self.track.track_number & 0x3f),
+                 led[1], led[2], 0xF7]))
+        self.track.desk.store.set_vpot(self.track.track_number, 0.5, UNSET)
         self.osc_address = '/track/c24vpot/{}'.format(
             self.track.track_number + 1)
         self.osc_message = OSC.OSCMessage(self.osc_address)
+        self.limiter = C24limiter(self._send_to_daw)
 
     def __str__(self):
-        return 'Channel:{}, Pan:{}, Pang:{}, Panv:{}, b:{} {} CmdBytes:{}'.format(
+        state = self.track.desk.store.state
+        return 'Channel:{}, Pan:{}, Pang:{}, {}'.format(
             self.track.track_number,
-            self.pan,
-            self.pang,
-            self.panv,
-            self.cmdbytes[5],
-            self.cmdbytes[6],
-            binascii.hexlify(self.cmdbytes)
+            state.pan[self.track.track_number],
+            state.vpot[self.track.track_number],
+            self.limiter
         )
 
+    @property
+    def pan(self):
+        """the pan value 0-1, kept in the desk store"""
+        return self.track.desk.store.state.pan[self.track.track_number]
+
     def d_c(self, parsedcmd):
         """Desk to Computer. Update from desk command byte list"""
-        cbytes = parsedcmd.get('cmdbytes')
-        for ind, byt in enumerate(cbytes):
-            self.cmdbytes_d_c[ind] = ord(byt)
-        self.adj_pan(self)
+        pan = self.adj_pan(self, parsedcmd.get('cmdbytes'))
+        self.update_led(pan)
+        self.limiter.offer()
+
+    def _send_to_daw(self):
+        """send the pan value to the DAW"""
         self.osc_message.clearData()
         self.osc_message.append(self.pan)
-        self.update_led()
         self.track.desk.osc_client_send(self.osc_message)
 
     def c_d(self, addrlist, stuff):
         """Computer to Desk. Update from DAW pan value (0-1)"""
-        pan = stuff[0]
-        self.pan = pan
-        self.update_led()
+        self.update_led(stuff[0])
 
-    def update_led(self):
+    def update_led(self, pan):
         """Update the LED display aroudn the vpot"""
-        if self.pan > 0 and self.pan < 1:
-            self.panv = self.pan - 0.5
-            self.pang = int(self.panv * 16) + 7
-        elif self.pan == 0:
-            self.panv = -0.5
-            self.pang = 0
-        elif self.pan == 1:
-            self.panv = 0.5
-            self.pang = 15
-        try:
-            led = self.led_value(self.pang)
-            self.cmdbytes[4], self.cmdbytes[5], self.cmdbytes[6] = led
-            self.cmdbytes[4] = self.cmdbytes[4] | (self.track.track_number & 0x3f)
-        except IndexError:
-            LOG.debug('VPOT LED lookup failure: %s', self)
-        self.track.desk.c24_client_send(self.cmdbytes)
-        LOG.debug('VPOT LED: %s', self)
+        pang = pan_ring(pan)
+        self.track.desk.store.set_vpot(self.track.track_number, pan, pang)
+        self.track.desk.c24_client_send(self.frames[pang])
+        if TRACE:
+            LOG.debug('VPOT LED: %s', self)
 
     @staticmethod
     def led_value(pang):
@@ -887,50 +1314,63 @@ class C24vpot(C24base):
         return C24vpot.scale_fill[pang]
 
     @staticmethod
-    def adj_pan(vpot):
-        """Increment/decrement the pan factor from command bytes"""
-        potdir = vpot.cmdbytes_d_c[2] - 64
-        potvel = vpot.cmdbytes_d_c[3]
+    def adj_pan(vpot, cbytes):
+        """Return the pan factor incremented/decremented
+        by the command bytes"""
+        potdir = ord(cbytes[2]) - 64
+        potvel = ord(cbytes[3])
         if vpot.track.desk.c24modifiers.command:
             amt = vpot.fine
         else:
             amt = vpot.coarse
         adj = potdir * amt
-        vpot.pan += adj
-        if vpot.pan > 1:
-            vpot.pan = 1
-        if vpot.pan < 0:
-            vpot.pan = 0
-        LOG.debug('vpot dir:%d vel:%d adj:%1.6f  pan:%1.6f',
-                  potdir, potvel, adj, vpot.pan)
-        return adj
+        pan = vpot.pan + adj
+        if pan > 1:
+            pan = 1
+        if pan < 0:
+            pan = 0
+        if TRACE:
+            LOG.debug('vpot dir:%d vel:%d adj:%1.6f  pan:%1.6f',
+                      potdir, potvel, adj, pan)
+        return pan
 
 
 class C24fader(C24base):
     """Class to hold and convert fader value representations"""
-    faderscale = C24base.calc_faderscale()
+    __slots__ = ('track', 'osc_address', 'osc_message', 'last_tick', 'touch_status',
+                 'sent', 'echoes', 'limiter')
 
     def __init__(self, track):
         self.track = track
-        self.gain = None
-        self.cmdbytes = (c_ubyte * 5)()
-        for ind, byt in enumerate(
-                [0xB0, self.track.track_number & 0x1F,
-                 0x00, self.track.track_number + 0x20, 0x00]):
-            self.cmdbytes[ind] = byt
         self.osc_address = '/track/c24fader/{}'.format(
             self.track.track_number + 1)
         self.osc_message = OSC.OSCMessage(self.osc_address)
         self.last_tick = 0.0
         self.touch_status = False
+        # (time, position) of recent moves sent to the DAW, to
+        # recognise them when the DAW sends them back
+        self.sent = collections.deque(maxlen=FADER_ECHO_SENT)
+        self.echoes = 0
+        self.limiter = C24limiter(self._send_to_daw)
 
     def __str__(self):
-        return 'Channel:{}, Gain:{}, CmdBytes:{}'.format(
+        return 'Channel:{}, Gain:{}, CmdBytes:{}, Echoes:{}, {}'.format(
             self.track.track_number,
-            self.gain,
-            binascii.hexlify(self.cmdbytes)
+            self.calc_gain(self),
+            binascii.hexlify(self.frame()),
+            self.echoes,
+            self.limiter
         )
 
+    @property
+    def position(self):
+        """the 10 bit fader position, kept in the desk store"""
+        return self.track.desk.store.state.fader[self.track.track_number]
+
+    def frame(self):
+        """the command bytes to move the fader to its position"""
+        return fader_frame(self.track.track_number, self.position)
+
     def d_c(self, parsedcmd):
         """Desk to Computer. Update from desk command byte list"""
         addr = parsedcmd.get('addresses')
@@ -942,12 +1382,33 @@ class C24fader(C24base):
             LOG.warn('Unknown command sent to fader class: %s', parsedcmd)
 
     def c_d(self, addrlist, stuff):
-        """Computer to Desk. Update from DAW gain factor (0-1)"""
-        gai = stuff[0]
-        self.gain = gai
-        self.cmdbytes[3] = 0x20 + self.track.track_number
-        self.cmdbytes[2], self.cmdbytes[4] = self.calc_cmdbytes(self)
-        self.track.desk.c24_client_send(self.cmdbytes)
+        """Computer to Desk. Update from DAW gain factor (0-1).
+        Ignored while the fader is touched, or if it is the DAW
+        echoing a move the fader made"""
+        position = self.calc_position(stuff[0])
+        if self.touch_status or self._is_echo(position):
+            self.echoes += 1
+            return
+        self.track.desk.store.set_fader(self.track.track_number, position)
+        self.track.desk.c24motors.move(self)
+
+    def _is_echo(self, position):
+        """True if a move close to this position was sent to
+        the DAW recently enough to be coming back"""
+        since = tick() - TIMING_FADER_ECHO_WINDOW
+        for sent_tick, sent_position in reversed(self.sent):
+            if sent_tick < since:
+                return False
+            if abs(sent_position - position) <= FADER_ECHO_TOLERANCE:
+                return True
+        return False
+
+    def _send_to_daw(self):
+        """send the fader position to the DAW, remembering it"""
+        self.sent.append((tick(), self.position))
+        self.osc_message.clearData()
+        self.osc_message.append(self.calc_gain(self))
+        self.track.desk.osc_client_send(self.osc_message)
 
     def _update_from_fadermove(self, parsedcmd):
         cbytes = parsedcmd.get('cmdbytes')
@@ -965,55 +1426,50 @@ class C24fader(C24base):
             LOG.warn('c24fader bad signature %s',
                      parsedcmd)
             return None
-        self.cmdbytes[2] = ord(cbytes[2])
-        self.cmdbytes[4] = ord(cbytes[4])
-        self.gain = self.calc_gain(self)
-        self.osc_message.clearData()
-        self.osc_message.append(self.gain)
-        self.track.desk.osc_client_send(self.osc_message)
+        self.track.desk.store.set_fader(
+            self.track.track_number,
+            fader_position_from_bytes(ord(cbytes[2]), ord(cbytes[4])))
+        self.track.desk.c24motors.moved(self)
+        self.limiter.offer()
         if tick() - self.last_tick > TIMING_FADER_ECHO:
-            self.track.desk.c24_client_send(self.cmdbytes)
+            self.track.desk.c24_client_send(self.frame())
         self.last_tick = tick()
 
     def _update_from_touch(self, parsedcmd):
         val = parsedcmd.get('Value')
         valb = bool(val)
-        if self.touch_status and not valb:
-            self.track.desk.c24_client_send(self.cmdbytes)
+        if self.touch_status and not valb and self.position != FADER_UNSET:
+            # Where the fader was let go is where both should be
+            self.limiter.cancel()
+            self._send_to_daw()
+            self.track.desk.c24_client_send(self.frame())
+            self.track.desk.c24motors.moved(self)
         self.touch_status = valb
 
     @staticmethod
-    def calc_cmdbytes(fdr):
-        """Calculate the command bytes from gain factor"""
-        gain_from_daw = fdr.gain
-        if gain_from_daw > 1:
-            gain_from_daw = 1
-        gain_tenbits = int(gain_from_daw * FADER_RANGE) - 1
-        if gain_tenbits < 0:
-            gain_tenbits = 0
-        tenb = C24base.tenbits(gain_tenbits)
-        return c_ubyte(tenb[0]), c_ubyte(tenb[1])
+    def calc_position(gain_from_daw):
+        """Calculate the 10 bit position from gain factor"""
+        return fader_position(gain_from_daw)
 
     @staticmethod
     def calc_gain(fdr):
-        """Calculate the gain factor from command bytes"""
-        volume_from_desk = (fdr.cmdbytes[2], fdr.cmdbytes[4])
-        return C24fader.faderscale[volume_from_desk]
-
+        """Calculate the gain factor from the position"""
+        return fader_gain(fdr.position)
 
 
 class C24buttonled(C24base):
     """ class to tidy up chunk of code from main c_d method
     for turning on/off button LED's """
+    __slots__ = ('desk', 'track', 'track_number')
     mapping_osc = {}
     C24base.walk(MAPPING_TREE.get(0x90).get('Children'),
                  '/button', [0x90, 0x00, 0x00], 1, None, mapping_osc)
+    frames_osc = C24base.led_frames(mapping_osc)
 
     def __init__(self, desk, track):
         self.desk = desk
         self.track = track
-        self.cmdbytes = (c_ubyte * 3)()
-        self.states = {}
+        self.track_number = None if track is None else track.track_number
 
     def c_d(self, addrlist, stuff):
         """computer to desk handler"""
@@ -1033,75 +1489,57 @@ class C24buttonled(C24base):
     def set_btn(self, addr, val):
         """set button value"""
         try:
-            lkpbtn = C24buttonled.mapping_osc[addr]
-            LOG.debug("Button LED: %s", lkpbtn)
-            if not self.track is None:
-                tbyt = lkpbtn.get('TrackByte')
-            else:
-                tbyt = None
-            tog = lkpbtn.get('Toggle')
-            if (tog and val == 1) or not tog:
-                if tog:
-                    vals = self.toggle_state(addr)
-                else:
-                    vals = val
-                # Copy the byte sequence injecting track number
-                for ind, byt in enumerate(lkpbtn['cmdbytes']):
-                    c_byt = c_ubyte(byt)
-                    if ind == tbyt and not self.track is None:
-                        c_byt.value = c_byt.value | self.track.track_number
-                    # On or Off
-                    if ind == 2 and vals == 1:
-                        c_byt.value = c_byt.value | 0x40
-                    self.cmdbytes[ind] = c_byt
-                LOG.debug("Button LED cmdbytes: %s", binascii.hexlify(self.cmdbytes))
-                self.desk.c24_client_send(self.cmdbytes)
-                return vals
+            tog, pairs = C24buttonled.frames_osc[addr]
         except KeyError:
             LOG.warn("OSCServer LED not found: %s %s", addr, str(val))
+            return None
+        # Frames with the track number injected, or the plain one
+        track_number = self.track_number if pairs.has_key(self.track_number) else None
+        if (tog and val == 1) or not tog:
+            if tog:
+                vals = self.toggle_state(addr, track_number)
+            else:
+                vals = val
+            self.desk.store.set_led(addr, track_number, vals == 1)
+            if TRACE:
+                LOG.debug("Button LED: %s %s", addr, vals)
+            self.desk.c24_client_send(pairs[track_number][vals == 1])
+            return vals
         return None
 
-    def toggle_state(self, addr):
+    def toggle_state(self, addr, track_number):
         """toggle between on and off states"""
-        state = self.states.get('addr') or 0.0
-        if state == 0.0:
-            state = 1.0
-        else:
-            state = 0.0
-        self.states[addr] = state
-        return state
-
-
-
-
+        if self.desk.store.led(addr, track_number):
+            return 0.0
+        return 1.0
 
 
 class C24automode(C24base):
     """ class to deal with the automation toggle on a track
     with the various LEDs and modes exchanged between DAW and desk"""
+    __slots__ = ('track', 'frames')
     automodes = {
-        'write' : {'state': False, 'cmd': 0x40},
-        'touch' : {'state': False, 'cmd': 0x20},
-        'latch' : {'state': False, 'cmd': 0x10},
-        'trim'  : {'state': False, 'cmd': 0x08},
-        'read'  : {'state': False, 'cmd': 0x04}
+        'write' : {'cmd': 0x40},
+        'touch' : {'cmd': 0x20},
+        'latch' : {'cmd': 0x10},
+        'trim'  : {'cmd': 0x08},
+        'read'  : {'cmd': 0x04}
     }
 
     def __init__(self, desk, track):
-        self.desk = desk
         self.track = track
-        self.cmdbytes = (c_ubyte * 30)()
-        for ind, byt in enumerate(
+        # Ready made frames for every combination of the mode LEDs
+        self.frames = {}
+        for bits in range(0, 0x80, 0x04):
+            self.frames[bits] = self.frame(
                 [0xF0, 0x13, 0x01, 0x20, self.track.track_number & 0x1F,
-                 0x00, 0xF7]):
-            self.cmdbytes[ind] = byt
-        self.modes = dict(self.automodes)
+                 bits, 0xF7] + [0x00] * 23)
 
     def __str__(self):
-        mods = ['{}:{}'.format(key, value.get('state')) for key, value in self.modes.iteritems()]
+        mods = ['{}:{}'.format(key, self.get_mode(key)) for key in self.automodes]
         return 'C24automode track:{} byt:{} modes:{} '.format(
             self.track.track_number,
-            self.cmdbytes[5],
+            self.track.desk.store.state.automode[self.track.track_number],
             mods
         )
 
@@ -1119,11 +1557,10 @@ class C24automode(C24base):
             first = None
             nxt = False
             moved = False
-            for key in self.modes.keys():
+            for key in self.automodes.keys():
                 if not first:
                     first = key
-                mode = self.modes.get(key)
-                if mode.get('state'):
+                if self.get_mode(key):
                     self.set_mode(key, False)
                     self.daw_mode(key, False)
                     moved = True
@@ -1147,22 +1584,91 @@ class C24automode(C24base):
         msg.append('{}.0'.format(onoff * 1))
         self.track.desk.osc_client_send(msg)
 
+    def get_mode(self, mode_in):
+        """True if the mode is on"""
+        bitv = self.automodes[mode_in]['cmd']
+        return self.track.desk.store.state.automode[self.track.track_number] & bitv != 0
+
     def set_mode(self, mode_in, onoff):
         """set the current mode state"""
-        mode = self.modes.get(mode_in)
-        mode['state'] = onoff
-        bitv = mode.get('cmd')
-        curv = self.cmdbytes[5]
-        if onoff and curv & bitv == 0:
-            curv += bitv
-        elif curv & bitv != 0 and not onoff:
-            curv -= bitv
-        self.cmdbytes[5] = curv
+        bitv = self.automodes[mode_in]['cmd']
+        curv = self.track.desk.store.state.automode[self.track.track_number]
+        if onoff:
+            curv |= bitv
+        else:
+            curv &= ~bitv
+        self.track.desk.store.set_automode(self.track.track_number, curv)
 
     def update_led(self):
         """Update the LED display by the auto toggle"""
-        self.track.desk.c24_client_send(self.cmdbytes)
-        LOG.debug('AUTO LED: %s', self)
+        bits = self.track.desk.store.state.automode[self.track.track_number]
+        self.track.desk.c24_client_send(self.frames[bits])
+        if TRACE:
+            LOG.debug('AUTO LED: %s', self)
+
+
+class C24queryhandler(SocketServer.StreamRequestHandler):
+    """One reader of the desk state. Each line asks for one of
+        snapshot        the whole state
+        since SEQ       what changed after SEQ
+        watch [SEQ]     the same, then changes as they happen
+    and each answer is one line of JSON with the seq it is up to,
+    whether it is the full state, and the changes"""
+
+    def handle(self):
+        store = self.server.store
+        for line in iter(self.rfile.readline, ''):
+            words = line.split()
+            try:
+                since = int(words[1]) if len(words) > 1 else None
+            except ValueError:
+                since = None
+                words = ['']
+            if not words or words[0] == 'snapshot':
+                self._answer(store.export())
+            elif words[0] == 'since':
+                self._answer(store.export(since))
+            elif words[0] == 'watch':
+                self._watch(store, since)
+                return
+            else:
+                self._answer({'error': 'unknown request {}'.format(line.strip())})
+
+    def _answer(self, answer):
+        self.wfile.write(json.dumps(answer, separators=(',', ':')))
+        self.wfile.write('\n')
+        self.wfile.flush()
+
+    def _watch(self, store, since):
+        """send changes until the reader goes away or the server closes"""
+        while not self.server.closing:
+            if since is None or store.seq != since:
+                answer = store.export(since)
+                self._answer(answer)
+                since = answer['seq']
+            time.sleep(TIMING_QUERY_WATCH)
+
+
+class C24queryserver(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serve the desk state store to readers on a local socket.
+    Readers only take the store lock to copy the journal, so they
+    never hold up the threads translating for the desk"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store):
+        SocketServer.TCPServer.__init__(self, address, C24queryhandler)
+        self.store = store
+        self.closing = False
+
+    def handle_error(self, request, client_address):
+        LOG.debug('Query reader %s went away', client_address, exc_info=True)
+
+    def close(self):
+        """stop serving and let watching readers finish"""
+        self.closing = True
+        self.shutdown()
+        self.server_close()
 
 
 class C24oscsession(object):
@@ -1291,15 +1797,24 @@ class C24oscsession(object):
         return parsedcmd
 
     # Event methods
+    def _daemon_control(self, msg):
+        """Act on a control message from the daemon"""
+        if msg == MP_ONLINE:
+            LOG.info('MP Client desk is online, bringing it up to date')
+            self.desk.request_resync()
+        else:
+            LOG.warn('MP Client unknown control message %s', binascii.hexlify(msg))
+
     def _desk_to_daw(self, c_databytes):
-        LOG.debug(binascii.hexlify(c_databytes))
         commands = C24oscsession.cmdsplit(c_databytes)
-        LOG.debug('nc: %d', len(commands))
+        if TRACE:
+            LOG.debug('nc: %d %s', len(commands), LazyHex(c_databytes))
         for cmd in commands:
             parsed_cmd = C24oscsession.parsecmd(cmd)
             if parsed_cmd:
                 address = parsed_cmd.get('address')
-                LOG.debug(parsed_cmd)
+                if TRACE:
+                    LOG.debug('%s', parsed_cmd)
                 # If we have a track number then get the corresponding object
                 track_number = parsed_cmd.get("TrackNumber")
                 track = self.desk.get_track(track_number)
@@ -1332,8 +1847,9 @@ class C24oscsession(object):
         """message handler for the OSC listener"""
         if self.osc_listener_last is None:
             self.osc_listener_last = source
-        LOG.debug("OSC Listener received Message: %s %s [%s] %s",
-                  source, addr, tags, str(stuff))
+        if TRACE:
+            LOG.debug("OSC Listener received Message: %s %s [%s] %s",
+                      source, addr, tags, stuff)
         # TODO primitive switching needs a proper lookup map
         addrlist = addr.split('/')
         if 'track' in addrlist:
@@ -1370,23 +1886,45 @@ class C24oscsession(object):
         while not self.is_closing:
             # Poll for a connection, in case server is not up
             LOG.debug('Starting MP client connecting to %s', self.server)
+            # Try again straight away, then back off up to the poll time
+            retry_wait = 0
             while self.c24_client is None:
+                if not self.local_conn is None:
+                    # Daemon is in this process, nothing to connect
+                    self.c24_client = self.local_conn
+                    break
                 try:
-                    self.c24_client = Client(
-                        self.server, authkey=DEFAULTS.get('auth'))
-                except Exception as exc:
-                    # Connection refused
-                    if exc[0] == 61:
-                        LOG.error(
-                            'Error trying to connect to control24d at %s. May not be running. Will try again.',
-                            self.server)
-                        time.sleep(TIMING_SERVER_POLL)
+                    if self.transport == 'link':
+                        self.c24_client = link_client(
+                            self.server, DEFAULTS.get('auth'))
+                    else:
+                        self.c24_client = Client(
+                            self.server, authkey=DEFAULTS.get('auth'))
+                except (socket.error, EOFError, AuthenticationError) as exc:
+                    err = getattr(exc, 'errno', None)
+                    if err in CONNECTION_REFUSED:
+                        if retry_wait == TIMING_SERVER_POLL:
+                            LOG.error(
+                                'Error trying to connect to control24d at %s. May not be running. Will try again.',
+                                self.server)
+                    elif err in CONNECTION_TRANSIENT or isinstance(exc, (socket.timeout, EOFError)):
+                        LOG.warn('Could not reach control24d at %s: %s. Will try again.',
+                                 self.server, exc or 'connection closed')
+                    elif isinstance(exc, AuthenticationError):
+                        LOG.error('control24d at %s did not accept the client: %s. Will try again.',
+                                  self.server, exc)
                     else:
                         LOG.error(
                             'c24 client Unhandled exception', exc_info=True)
                         raise
+                    time.sleep(retry_wait)
+                    retry_wait = min(max(retry_wait * 2, TIMING_SERVER_RETRY),
+                                     TIMING_SERVER_POLL)
 
+            if self.desk_index:
+                mp_select_desk(self.c24_client, self.desk_index)
             self.c24_client_is_connected = True
+            LOG.info('MP Client connected to %s', self.server)
 
             # Main Loop when connected
             while self.c24_client_is_connected:
@@ -1394,12 +1932,16 @@ class C24oscsession(object):
                           self.c24_client.fileno())
                 try:
                     datarecv = self.c24_client.recv_bytes()
-                    self._desk_to_daw(datarecv)
+                    if datarecv[:1] == MP_CONTROL:
+                        self._daemon_control(datarecv)
+                    else:
+                        self._desk_to_daw(datarecv)
                 except EOFError:
                     LOG.error('MP Client EOFError: Daemon closed communication.')
                     self.c24_client_is_connected = False
                     self.c24_client = None
-                    time.sleep(TIMING_SERVER_POLL)
+                    if not self.local_conn is None:
+                        return
                 except Exception:
                     LOG.error("C24 client Uncaught exception", exc_info=True)
                     raise
@@ -1473,7 +2015,8 @@ class C24oscsession(object):
         that are wrapped in a connection check"""
         if not simplevalue is None:
             osc_msg.append(simplevalue)
-        LOG.debug('OSCClient sending: %s', osc_msg)
+        if TRACE:
+            LOG.debug('OSCClient sending: %s', osc_msg)
         if self.osc_client_is_connected:
             try:
                 self.osc_client.send(osc_msg)
@@ -1486,29 +2029,105 @@ class C24oscsession(object):
                 "OSC Client not connected but message send request received: %s", osc_msg)
 
     def c24_client_send(self, cmdbytes):
-        """dry up the calls to the MP send that
-        are wrapped in a connection check"""
+        """queue a command for the daemon in its priority class,
+        if connected"""
+        if self.c24_client_is_connected:
+            # copy, as callers reuse their command byte arrays
+            if not isinstance(cmdbytes, str):
+                cmdbytes = str(bytearray(cmdbytes))
+            if TRACE:
+                LOG.debug("MP send: %s", LazyHex(cmdbytes))
+            if not self.local_conn is None:
+                self._local_send(cmdbytes)
+                return
+            self.c24_sendq.put(classify(cmdbytes), cmdbytes, command_key(cmdbytes))
+            self.c24_send_pending.set()
+
+    def c24_client_batch(self, cmds):
+        """queue a list of commands to go to the desk together,
+        return True if they were queued"""
         if self.c24_client_is_connected:
-            LOG.debug("MP send: %s",
-                      binascii.hexlify(cmdbytes))
-            self.c24_client.send_bytes(cmdbytes)
+            LOG.debug("MP send batch of %d", len(cmds))
+            for msg in mp_batches(cmds):
+                if not self.local_conn is None:
+                    self._local_send(msg)
+                else:
+                    self.c24_sendq.put(classify(msg), msg)
+            self.c24_send_pending.set()
+            return True
+        return False
+
+    def _local_send(self, msg):
+        """hand a command to a daemon in this process. It goes
+        straight into the desk's queue, which sorts it by class
+        and replaces by key, so it needs no queue of its own here"""
+        try:
+            self.local_conn.send_bytes(msg)
+        except (IOError, EOFError):
+            LOG.debug('MP send failed, connection is going', exc_info=True)
+
+    def _c24_sender(self):
+        """send queued commands to the daemon, highest class first.
+        Log how long each class waited now and then"""
+        last_stats = tick()
+        while not self.is_closing:
+            self.c24_send_pending.wait(TIMING_MP_POLL)
+            self.c24_send_pending.clear()
+            if tick() - last_stats >= TIMING_STATS:
+                last_stats = tick()
+                LOG.info('Stats: %s', self)
+                self.c24_sendq.reset_waits()
+            while True:
+                try:
+                    __, msg = self.c24_sendq.get_nowait()
+                except Queue.Empty:
+                    break
+                if not self.c24_client_is_connected:
+                    continue
+                try:
+                    self.c24_client.send_bytes(msg)
+                except (IOError, EOFError):
+                    LOG.debug('MP send failed, connection is going', exc_info=True)
 
     # session housekeeping methods
-    def __init__(self, opts, networks):
-        """Contructor to build the client session object"""
-        global LOG
+    def __init__(self, opts, networks, local_conn=None):
+        """Contructor to build the client session object.
+        Supply local_conn to talk to a daemon session in this
+        process instead of connecting to one over the network"""
+        global LOG, TRACE
         LOG = start_logging('control24osc', opts.logdir, opts.debug)
-        self.desk = C24desk(self.osc_client_send, self.c24_client_send)
-
-        self.server = OSC.parseUrlStr(opts.server)[0]
+        TRACE = tracing(LOG)
+        self.desk = C24desk(self.osc_client_send, self.c24_client_send,
+                            self.c24_client_batch)
+        self.desk.c24clock.set_rate(opts.clock_rate)
+        self.desk.set_control_window(getattr(opts, 'control_window', TIMING_CONTROL_WINDOW))
+        state_file = getattr(opts, 'state_file', None)
+        if state_file is None:
+            state_file = os.path.join(opts.logdir, STATE_FILE.format(opts.desk))
+        if state_file != '-':
+            try:
+                self.desk.restore_state(state_file)
+            except (IOError, OSError, ValueError) as err:
+                LOG.warn('Desk state file %s not used: %s', state_file, err)
+
+        self.local_conn = local_conn
+        self.desk_index = opts.desk
+        self.transport = opts.transport
+        if local_conn is None:
+            self.server = OSC.parseUrlStr(opts.server)[0]
+        else:
+            self.server = 'local'
         self.listen = OSC.parseUrlStr(opts.listen)[0]
         self.connect = OSC.parseUrlStr(opts.connect)[0]
         self.osc_listener = None
         self.osc_listener_last = None
+        self.query_server = None
         self.osc_client = None
         self.osc_client_is_connected = False
         self.c24_client = None
         self.c24_client_is_connected = False
+        self.c24_sendq = ClassQueue(MP_QUEUE_SIZE)
+        self.c24_send_pending = threading.Event()
         self.is_closing = False
 
         # Start a thread to manage the connection to the control24d
@@ -1519,6 +2138,14 @@ class C24oscsession(object):
         self.thread_c24_client.daemon = True
         self.thread_c24_client.start()
 
+        # Start a thread to send to the control24d
+        self.thread_c24_sender = threading.Thread(
+            target=self._c24_sender,
+            name='thread_c24_sender'
+        )
+        self.thread_c24_sender.daemon = True
+        self.thread_c24_sender.start()
+
         # Start a thread to manage the OSC Listener
         self.thread_osc_listener = threading.Thread(
             target=self._manage_osc_listener,
@@ -1535,11 +2162,37 @@ class C24oscsession(object):
         self.thread_osc_client.daemon = True
         self.thread_osc_client.start()
 
+        # Serve the desk state to local readers
+        query = getattr(opts, 'query', '-')
+        if query is None:
+            query = '127.0.0.1:{}'.format(DEFAULTS.get('query') + opts.desk)
+        if query != '-':
+            try:
+                self.query_server = C24queryserver(
+                    OSC.parseUrlStr(query)[0], self.desk.store)
+            except socket.error as err:
+                LOG.warn('Desk state query socket %s not started: %s', query, err)
+            else:
+                thread_query = threading.Thread(
+                    target=self.query_server.serve_forever,
+                    name='thread_query'
+                )
+                thread_query.daemon = True
+                thread_query.start()
+                LOG.info('Desk state query socket at %s', query)
+
     def __str__(self):
         """pretty print session state if requested"""
-        return 'control24 osc session: c24client_is_connected:{}'.format(
-            self.c24_client_is_connected
-        )
+        rtt = getattr(self.c24_client, 'rtt', None)
+        limiters = self.desk.limiters()
+        return 'control24 osc session: c24client_is_connected:{}{} waits {} ' \
+            'controls passed:{} merged:{}'.format(
+                self.c24_client_is_connected,
+                '' if rtt is None else ' rtt:{:.2f}ms'.format(rtt * 1000),
+                self.c24_sendq,
+                sum(limiter.passed for limiter in limiters),
+                sum(limiter.merged for limiter in limiters)
+            )
 
     def close(self):
         """Placeholder if we need a shutdown method"""
@@ -1549,6 +2202,10 @@ class C24oscsession(object):
         # For others ask nicely
         if not self.osc_listener is None and self.osc_listener.running:
             self.osc_listener.close()
+        if not self.query_server is None:
+            self.query_server.close()
+            self.query_server = None
+        self.desk.store.close()
         LOG.info("C24oscsession closed")
 
     def __del__(self):
@@ -1589,14 +2246,29 @@ def main():
         dest="connect",
         help="Connect to DAW OSC server at host:port. default %s" % default_daw)
 
+    opts_transport(oprs)
+    oprs.add_option(
+        "--desk",
+        dest="desk",
+        type="int",
+        help="drive this desk, when control24d serves more than one. default 0")
+    opts_clock(oprs)
+    opts_state(oprs)
+    opts_query(oprs)
+    opts_controls(oprs)
+
     oprs.set_defaults(listen=default_osc_client24,
-                      server=default_daemon, connect=default_daw)
+                      server=default_daemon, connect=default_daw, desk=0)
 
     # Parse and verify options
     # TODO move to argparse and use that to verify
     (opts, _) = oprs.parse_args()
     if not networks.verify_ip(opts.listen.split(':')[0]):
         raise OptionError('No network has the IP address specified.', 'listen')
+    if opts.clock_rate <= 0:
+        raise OptionError('Clock rate must be more than 0.', 'clock_rate')
+    if opts.control_window < 0:
+        raise OptionError('Control window can not be negative.', 'control_window')
 
     # Set up Interrupt signal handler so process can close cleanly
     for sig in [signal.SIGINT]:
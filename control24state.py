@@ -0,0 +1,359 @@
+"""Desk state store. The state of every control on the desk lives in
+one contiguous ctypes structure, indexed by track and control, which
+the control objects read and write through. The structure can be
+mapped onto a file so that it outlives the process"""
+
+import collections
+import mmap
+import os
+import threading
+import zlib
+from ctypes import (Structure, addressof, c_char, c_float, c_ubyte, c_uint16,
+                    c_uint32, memmove, sizeof, string_at)
+
+'''
+    This file is part of ReaControl24. Control Surface Middleware.
+    Copyright (C) 2018  PhaseWalker
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+TRACKS = 32
+# LED state is kept for each track, plus one for the desk itself
+LED_TRACKS = TRACKS + 1
+LED_DESK = TRACKS
+SPEAKERS = 2
+TEXT_SLOTS = 8
+TEXT_LENGTH = 8
+TEXT_NAME_LENGTH = 48
+UNSET = 0xFF
+FADER_UNSET = 0xFFFF
+# Slots for the names of the modes the desk is in
+MODE_SLOTS = 4
+MODE_LENGTH = 16
+MODE_DESK = 0
+MODE_CLOCK = 1
+MODE_NAV = 2
+MODE_NAMES = ('desk', 'clock', 'nav')
+# Changes remembered for readers asking what changed since a seq.
+# Meters change too often to journal, each track notes its last seq
+JOURNAL_SIZE = 4096
+
+# State file header. Bump the version whenever the layout changes
+STATE_MAGIC = 'C24STATE'
+STATE_VERSION = 2
+
+
+class C24stateheader(Structure):
+    """identifies a state file and the layout of what follows"""
+    _pack_ = 1
+    _fields_ = [
+        ("magic", c_char * 8),
+        ("version", c_uint32),
+        ("size", c_uint32),
+        ("layout", c_uint32)
+    ]
+
+
+def c24state_factory(leds):
+    """dynamically build and return the state structure class
+    with room for the number of button LED addresses given"""
+
+    class C24state(Structure):
+        """every control's state in one block of memory"""
+        _pack_ = 1
+        _fields_ = [
+            ("seq", c_uint32),
+            ("fader", c_uint16 * TRACKS),
+            ("pan", c_float * TRACKS),
+            ("vpot", c_ubyte * TRACKS),
+            ("automode", c_ubyte * TRACKS),
+            ("meter", (c_ubyte * (2 * SPEAKERS)) * TRACKS),
+            ("scribble", (c_char * 4) * TRACKS),
+            ("text", ((c_char * TEXT_LENGTH) * TEXT_SLOTS) * TRACKS),
+            ("text_name", (c_char * TEXT_NAME_LENGTH) * TEXT_SLOTS),
+            ("mode", (c_char * MODE_LENGTH) * MODE_SLOTS),
+            ("led", (c_ubyte * LED_TRACKS) * leds)
+        ]
+
+    return C24state
+
+
+class C24store(object):
+    """The desk state, with a method for each kind of write so that
+    every change bumps the sequence number. Controls keep only their
+    track number and read their state back from here"""
+    __slots__ = ('state', 'led_index', 'text_index', 'lock', 'layout',
+                 'path', 'mapped', 'restored', 'journal', 'forgotten', 'meter_seq')
+
+    def __init__(self, led_addresses, text_addresses):
+        """led_addresses and text_addresses are the known OSC
+        addresses, in a fixed order so the layout is repeatable"""
+        leds = sorted(led_addresses)
+        self.led_index = dict((addr, ind) for ind, addr in enumerate(leds))
+        self.text_index = {}
+        self.state = c24state_factory(len(self.led_index))()
+        self.lock = threading.Lock()
+        # The LED rows depend on the addresses, so they are part of the layout
+        self.layout = zlib.crc32('\n'.join(leds)) & 0xFFFFFFFF
+        self.path = None
+        self.mapped = None
+        self.restored = False
+        self.journal = collections.deque(maxlen=JOURNAL_SIZE)
+        # The seq of the newest change no longer in the journal
+        self.forgotten = 0
+        self.meter_seq = [0] * TRACKS
+        for track in range(TRACKS):
+            self.state.vpot[track] = UNSET
+            self.state.fader[track] = FADER_UNSET
+        for address in text_addresses:
+            self._text_slot(address)
+
+    def __str__(self):
+        return 'C24store seq:{} bytes:{} file:{}'.format(
+            self.state.seq, sizeof(self.state), self.path)
+
+    def map_file(self, path):
+        """Keep the state in a memory mapped file from now on. If the
+        file holds state of the same layout that state is restored,
+        otherwise the file is started from the current state.
+        Returns True if state was restored"""
+        header = C24stateheader(STATE_MAGIC, STATE_VERSION, sizeof(self.state), self.layout)
+        total = sizeof(header) + sizeof(self.state)
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        with open(path, mode) as statefile:
+            statefile.seek(0, os.SEEK_END)
+            restore = statefile.tell() == total
+            if not restore:
+                statefile.truncate(total)
+            mapped = mmap.mmap(statefile.fileno(), total)
+        current = C24stateheader.from_buffer(mapped)
+        restore = restore and string_at(addressof(current), sizeof(current)) == \
+            string_at(addressof(header), sizeof(header))
+        state = type(self.state).from_buffer(mapped, sizeof(header))
+        with self.lock:
+            if restore:
+                self.text_index = dict(
+                    (state.text_name[slot].value, slot) for slot in range(TEXT_SLOTS)
+                    if state.text_name[slot].value)
+            else:
+                memmove(addressof(state), addressof(self.state), sizeof(self.state))
+                memmove(addressof(current), addressof(header), sizeof(header))
+            self.state = state
+            self.mapped = mapped
+            self.path = path
+            self.restored = restore
+            if restore:
+                # What changed before the restart is not in the journal
+                self.forgotten = self.state.seq
+                self.meter_seq = [self.state.seq] * TRACKS
+        return restore
+
+    def close(self):
+        """Write the state file out and go back to state in memory"""
+        with self.lock:
+            if self.mapped is None:
+                return
+            self.state = type(self.state).from_buffer_copy(self.state)
+            self.mapped.flush()
+            # Not closed here, as readers may still hold the mapped
+            # structure. It is unmapped once the last of them is gone
+            self.mapped = None
+
+    @property
+    def seq(self):
+        """sequence number of the last change"""
+        return self.state.seq
+
+    def snapshot(self):
+        """return a copy of the whole state as a string"""
+        with self.lock:
+            return string_at(addressof(self.state), sizeof(self.state))
+
+    def changed(self, snapshot):
+        """return the names of the fields that differ from a snapshot"""
+        now = self.snapshot()
+        return [name for name, __ in self.state._fields_[1:]
+                if now[self._field_slice(name)] != snapshot[self._field_slice(name)]]
+
+    def _field_slice(self, name):
+        field = getattr(type(self.state), name)
+        return slice(field.offset, field.offset + field.size)
+
+    def _changed(self, key):
+        """bump the sequence number and note what changed,
+        called with the lock held"""
+        self.state.seq += 1
+        if len(self.journal) == JOURNAL_SIZE:
+            self.forgotten = self.journal[0][0]
+        self.journal.append((self.state.seq, key))
+
+    def _keys(self):
+        """every key export can report a change under"""
+        keys = []
+        for track in range(TRACKS):
+            keys.extend([('fader', track), ('pan', track), ('automode', track),
+                         ('meter', track), ('scribble', track)])
+            keys.extend(('text', track, address) for address in self.text_index)
+        keys.extend(('mode', slot) for slot in range(len(MODE_NAMES)))
+        keys.extend(('led', addr, track) for addr, track in self.leds_on())
+        return keys
+
+    def export(self, since=None):
+        """Return a dict of the state for readers outside the process.
+        With since, only what changed after that seq is included, unless
+        the journal no longer reaches back that far. The values are read
+        after the seq, so may be newer than it but never older"""
+        with self.lock:
+            seq = self.state.seq
+            full = since is None or since > seq or since < self.forgotten
+            if full:
+                keys = None
+            else:
+                keys = set(key for kseq, key in self.journal if kseq > since)
+                keys.update(('meter', track) for track, mseq in enumerate(self.meter_seq)
+                            if mseq > since)
+        if keys is None:
+            keys = self._keys()
+        state = self.state
+        changes = {}
+        for key in keys:
+            kind = key[0]
+            if kind == 'fader':
+                value = state.fader[key[1]]
+                if value == FADER_UNSET:
+                    value = None
+            elif kind == 'pan':
+                value = state.pan[key[1]]
+            elif kind == 'automode':
+                value = state.automode[key[1]]
+            elif kind == 'meter':
+                value = list(state.meter[key[1]])
+            elif kind == 'scribble':
+                value = state.scribble[key[1]].value
+            elif kind == 'text':
+                value = self.text(key[1], key[2])
+            elif kind == 'mode':
+                changes.setdefault('mode', {})[MODE_NAMES[key[1]]] = self.mode(key[1])
+                continue
+            else:
+                changes.setdefault('led', {}).setdefault(key[1], {})[
+                    'desk' if key[2] is None else key[2]] = self.led(key[1], key[2])
+                continue
+            if kind == 'text':
+                changes.setdefault('text', {}).setdefault(key[2], {})[key[1]] = value
+            else:
+                changes.setdefault(kind, {})[key[1]] = value
+        return {'seq': seq, 'full': full, 'changes': changes}
+
+    def set_fader(self, track, position):
+        """store a 10 bit fader position"""
+        with self.lock:
+            self.state.fader[track] = position
+            self._changed(('fader', track))
+
+    def set_vpot(self, track, pan, pang):
+        """store a pan value and the LED ring step showing it"""
+        with self.lock:
+            self.state.pan[track] = pan
+            self.state.vpot[track] = pang
+            self._changed(('pan', track))
+
+    def set_automode(self, track, bits):
+        """store the automation mode LED bits"""
+        with self.lock:
+            self.state.automode[track] = bits
+            self._changed(('automode', track))
+
+    def set_meter(self, track, speaker, level):
+        """store the two level bytes of one meter"""
+        with self.lock:
+            meter = self.state.meter[track]
+            meter[2 * speaker], meter[2 * speaker + 1] = level
+            # Not journalled, so meters can't push out other changes
+            self.state.seq += 1
+            self.meter_seq[track] = self.state.seq
+
+    def meter(self, track, speaker):
+        """return the two level bytes of one meter"""
+        meter = self.state.meter[track]
+        return meter[2 * speaker], meter[2 * speaker + 1]
+
+    def set_led(self, addr, track, onoff):
+        """store a button LED as on or off, track None for the desk"""
+        with self.lock:
+            self.state.led[self.led_index[addr]][
+                LED_DESK if track is None else track] = onoff
+            self._changed(('led', addr, track))
+
+    def led(self, addr, track):
+        """return a button LED state"""
+        return self.state.led[self.led_index[addr]][
+            LED_DESK if track is None else track]
+
+    def leds_on(self):
+        """return (address, track) for every LED that is on,
+        track None for the desk"""
+        found = []
+        for addr, ind in self.led_index.iteritems():
+            row = self.state.led[ind]
+            # skip the rows that are all off without a python loop
+            if not string_at(addressof(row), LED_TRACKS).strip('\x00'):
+                continue
+            for track, onoff in enumerate(row):
+                if onoff:
+                    found.append((addr, None if track == LED_DESK else track))
+        return found
+
+    def set_scribble(self, track, text4ch):
+        """store the 4 characters a scribble strip shows"""
+        with self.lock:
+            self.state.scribble[track].value = text4ch
+            self._changed(('scribble', track))
+
+    def _text_slot(self, address):
+        slot = self.text_index.get(address)
+        if slot is None and len(self.text_index) < TEXT_SLOTS \
+                and len(address) <= TEXT_NAME_LENGTH:
+            slot = self.text_index[address] = len(self.text_index)
+            self.state.text_name[slot].value = address
+        return slot
+
+    def set_text(self, track, address, text):
+        """store the DAW's text for a scribble strip address.
+        Returns False if there is no slot left for the address"""
+        with self.lock:
+            slot = self._text_slot(address)
+            if slot is None:
+                return False
+            self.state.text[track][slot].value = str(text)[:TEXT_LENGTH]
+            self._changed(('text', track, address))
+        return True
+
+    def text(self, track, address):
+        """return the DAW's text for a scribble strip address, if any"""
+        slot = self.text_index.get(address)
+        if slot is None:
+            return None
+        return self.state.text[track][slot].value
+
+    def set_mode(self, slot, mode):
+        """store the name of a mode the desk is in"""
+        with self.lock:
+            self.state.mode[slot].value = mode[:MODE_LENGTH]
+            self._changed(('mode', slot))
+
+    def mode(self, slot):
+        """return the name of a mode the desk is in, if set"""
+        return self.state.mode[slot].value or None